@@ -0,0 +1,44 @@
+import torch
+
+from lang.astnode import slot_descriptors
+from model.x2x import Tree2TreeModel
+from model.utils import device_map_location
+
+
+def benchmark_model(args, emb, dataset, name):
+    """
+    configures the vocabulary and grammar sizes of the dataset as main.py does
+    :param name: name of the dataset, a trained model of args.model is used for its own dataset only,
+                 the other datasets get a new untrained model
+    :return: the model for the dataset
+    """
+    args.source_vocab_size = dataset.vocab.size()
+    args.target_vocab_size = dataset.terminal_vocab.size()
+    args.rule_num = len(dataset.grammar.rules)
+    args.node_num = len(dataset.grammar.node_type_to_id)
+
+    if args.model and args.dataset == name.lower():
+        model = torch.load(args.model, device_map_location(False))
+        # models saved before an option was introduced take its current value
+        for key, value in vars(args).items():
+            if not hasattr(model.config, key):
+                setattr(model.config, key, value)
+        return model
+    return Tree2TreeModel(args, emb, dataset.terminal_vocab, dataset.grammar)
+
+
+def node_state(node):
+    """
+    :return: the attributes of a node as every node was pickled on its own before the trees were
+             pickled as flat lists of nodes, without the memoized hash
+    """
+    state = dict()
+    for name, slot in slot_descriptors(type(node)):
+        try:
+            state[name] = slot.__get__(node)
+        except AttributeError:
+            # unset slot, like the parent of a rule
+            pass
+    state.pop('_hash', None)
+    state.pop('_hash_epoch', None)
+    return state
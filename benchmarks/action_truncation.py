@@ -0,0 +1,60 @@
+import os
+import time
+import torch
+
+from config import parser
+from utils.general import get_batches
+from benchmarks import benchmark_model
+import datasets.hs
+import datasets.django
+
+
+def get_batch_padded(dataset, indices):
+    """
+    batch assembly as it was done before the targets were cut to the longest action sequence of the batch
+    """
+    trees, queries, _, _, _, _, _ = dataset.get_batch(indices)
+
+    return trees, queries, \
+           dataset.tgt_node_seq[indices], dataset.tgt_par_rule_seq[indices], dataset.tgt_par_t_seq[indices], \
+           dataset.tgt_action_seq[indices], dataset.tgt_action_seq_type[indices]
+
+
+def time_per_batch(get_batch, model, dataset, batches):
+    """
+    :return: average time of one training step (forward and backward pass) in milliseconds
+    """
+    start = time.perf_counter()
+    for batch in batches:
+        trees, queries, tgt_node_seq, tgt_par_rule_seq, tgt_par_t_seq, \
+        tgt_action_seq, tgt_action_seq_type = get_batch(dataset, batch)
+
+        loss = model.forward_train(trees, queries, tgt_node_seq, tgt_action_seq, tgt_par_rule_seq, tgt_par_t_seq, tgt_action_seq_type)
+        loss.backward()
+        model.zero_grad()
+    return (time.perf_counter() - start) * 1000 / len(batches)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    args.cuda = False
+    batch_num = 20
+
+    emb = torch.load(os.path.join(args.data_dir, 'word_embeddings.pth'))
+
+    for name, load_dataset in [('HS', datasets.hs.load_dataset), ('Django', datasets.django.load_dataset)]:
+        train, _, _ = load_dataset(args)
+        model = benchmark_model(args, emb, train, name)
+        model.train()
+
+        batches = list(get_batches(torch.randperm(len(train)), args.batch_size))[:batch_num]
+        steps = sum([int(train.action_lengths[batch].max()) for batch in batches]) / len(batches)
+
+        before = time_per_batch(get_batch_padded, model, train, batches)
+        after = time_per_batch(lambda d, b: d.get_batch(b), model, train, batches)
+        print("{} training step (batch size {}):\n"
+              "decoder steps: {} padded, {:.1f} on average truncated,\n"
+              "padded: {:.3f} ms/batch,\n"
+              "truncated: {:.3f} ms/batch,\n"
+              "speedup: {:.1f}x.".format(name, args.batch_size, train.tgt_action_seq.shape[1], steps,
+                                         before, after, before / after))
@@ -0,0 +1,52 @@
+import time
+from copy import deepcopy
+import torch
+
+import Constants
+from config import parser
+from utils.general import get_batches
+import datasets.hs
+import datasets.django
+
+
+def get_batch_deepcopy(dataset, indices):
+    """
+    batch assembly as it was done while the encoder stored its states inside the query trees
+    """
+    data_entries = [dataset.data_entries[index] for index in indices]
+    trees = [deepcopy(data_entry['query_tree']) for data_entry in data_entries]
+    queries = [data_entry['query'] for data_entry in data_entries]
+    max_tree_length = max([tree.size() for tree in trees])
+
+    queries = torch.stack(dataset.fix_seq_length(queries, max_tree_length, Constants.PAD))
+
+    return trees, queries, \
+           dataset.tgt_node_seq[indices], dataset.tgt_par_rule_seq[indices], dataset.tgt_par_t_seq[indices], \
+           dataset.tgt_action_seq[indices], dataset.tgt_action_seq_type[indices]
+
+
+def time_per_batch(get_batch, dataset, batch_size, repeat):
+    """
+    :return: average assembly time of one batch in milliseconds
+    """
+    batches = list(get_batches(torch.randperm(len(dataset)), batch_size))
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for batch in batches:
+            get_batch(dataset, batch)
+    return (time.perf_counter() - start) * 1000 / (repeat * len(batches))
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    args.cuda = False
+    repeat = 3
+
+    for name, load_dataset in [('HS', datasets.hs.load_dataset), ('Django', datasets.django.load_dataset)]:
+        train, _, _ = load_dataset(args)
+        before = time_per_batch(get_batch_deepcopy, train, args.batch_size, repeat)
+        after = time_per_batch(lambda d, b: d.get_batch(b), train, args.batch_size, repeat)
+        print("{} batch assembly (batch size {}):\n"
+              "deepcopy: {:.3f} ms/batch,\n"
+              "zero-copy: {:.3f} ms/batch,\n"
+              "speedup: {:.1f}x.".format(name, args.batch_size, before, after, before / after))
@@ -0,0 +1,48 @@
+import os
+import time
+import torch
+from collections import Counter
+
+from config import parser
+from benchmarks import benchmark_model
+import datasets.hs
+import datasets.django
+
+
+def time_per_example(model, dataset, indices, decode_mode, beam_size):
+    """
+    :return: average decoding time of one example in milliseconds and average decoder steps of one example,
+             the examples are decoded one by one
+    """
+    model.config.decode_mode = decode_mode
+    model.config.beam_size = beam_size
+    model.decode_counters = Counter()
+
+    start = time.perf_counter()
+    for index in indices:
+        data_entries, trees, queries = dataset.get_decode_batch([index])
+        model.decode_batch(trees, queries, [data_entries[0]['query_tokens']])
+    return (time.perf_counter() - start) * 1000 / len(indices), model.decode_counters['steps'] / len(indices)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    args.cuda = False
+    example_num = 50
+
+    emb = torch.load(os.path.join(args.data_dir, 'word_embeddings.pth'))
+
+    for name, load_dataset in [('HS', datasets.hs.load_dataset), ('Django', datasets.django.load_dataset)]:
+        _, _, test = load_dataset(args)
+        # a trained model of its dataset decodes realistic lengths, an untrained one runs until decode_max_time_step
+        model = benchmark_model(args, emb, test, name)
+        model.eval()
+
+        indices = list(range(min(example_num, len(test))))
+        greedy, greedy_steps = time_per_example(model, test, indices, 'greedy', 1)
+        print("{} decoding latency ({} examples):\n"
+              "greedy: {:.3f} ms/example, {:.1f} steps/example".format(name, len(indices), greedy, greedy_steps))
+        for beam_size in [1, 5, 10]:
+            beam, beam_steps = time_per_example(model, test, indices, 'beam', beam_size)
+            print("beam {}: {:.3f} ms/example, {:.1f} steps/example, {:.1f}x greedy".format(beam_size, beam, beam_steps,
+                                                                                           beam / greedy))
@@ -0,0 +1,51 @@
+import os
+import time
+import torch
+from collections import Counter
+
+from config import parser
+from utils.general import get_batches
+from benchmarks import benchmark_model
+import datasets.hs
+import datasets.django
+
+
+def decode(model, dataset, beam_stop):
+    """
+    :return: top-1 trees of the examples, decoding counters and the decoding time in seconds
+    """
+    model.config.beam_stop = beam_stop
+    model.decode_counters = Counter()
+    top_trees = []
+
+    start = time.perf_counter()
+    for batch in get_batches(list(range(len(dataset))), model.config.decode_batch_size):
+        data_entries, trees, queries = dataset.get_decode_batch(batch)
+        cand_lists = model.decode_batch(trees, queries, [data_entry['query_tokens'] for data_entry in data_entries])
+        top_trees.extend([repr(cand_list[0].tree) if cand_list else None for cand_list in cand_lists])
+    return top_trees, model.decode_counters, time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    args.cuda = False
+
+    emb = torch.load(os.path.join(args.data_dir, 'word_embeddings.pth'))
+
+    for name, load_dataset in [('HS', datasets.hs.load_dataset), ('Django', datasets.django.load_dataset)]:
+        _, _, test = load_dataset(args)
+        model = benchmark_model(args, emb, test, name)
+        model.eval()
+
+        full_trees, full_counters, full_time = decode(model, test, 'none')
+        print("{} test set beam search ({} examples, beam size {}):\n"
+              "no early stop: {} decoder steps, {:.1f} s".format(name, len(test), model.config.beam_size,
+                                                                 full_counters['steps'], full_time))
+        for beam_stop in ['top1', 'all']:
+            trees, counters, seconds = decode(model, test, beam_stop)
+            print("{}: {} decoder steps, {} saved ({:.1%}), {} examples stopped early, {:.1f} s,\n"
+                  "identical top-1: {}/{}".format(beam_stop, counters['steps'],
+                                                  full_counters['steps'] - counters['steps'],
+                                                  1 - counters['steps'] / max(1, full_counters['steps']),
+                                                  counters['early_stops'], seconds,
+                                                  sum(a == b for a, b in zip(full_trees, trees)), len(test)))
@@ -0,0 +1,43 @@
+import os
+import pickle
+import time
+
+from utils.io import deserialize_from_file
+
+
+def load_time(data, repeat):
+    """
+    :return: best unpickling time of the pickled grammar in milliseconds
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        pickle.loads(data)
+        times.append(time.perf_counter() - start)
+    return min(times) * 1000
+
+
+def pickle_without_tables(grammar):
+    """
+    the grammar pickled as before the tables were introduced, the tables are compiled when it is loaded
+    """
+    tables = grammar.__dict__.pop('tables')
+    try:
+        return pickle.dumps(grammar, pickle.HIGHEST_PROTOCOL)
+    finally:
+        grammar.tables = tables
+
+
+if __name__ == '__main__':
+    repeat = 10
+
+    for name, data_dir in [('HS', './preprocessed/hs'), ('Django', './preprocessed/django')]:
+        for file_name in ['grammar.txt.bin', 'grammar.txt.uc.bin']:
+            grammar = deserialize_from_file(os.path.join(data_dir, file_name))
+            with_tables = load_time(pickle.dumps(grammar, pickle.HIGHEST_PROTOCOL), repeat)
+            without_tables = load_time(pickle_without_tables(grammar), repeat)
+            print("{} {} ({} rules):\n"
+                  "compiling the tables on load: {:.1f} ms,\n"
+                  "pickled tables: {:.1f} ms,\n"
+                  "saved: {:.1f} ms per load.".format(name, file_name, len(grammar.rules), without_tables,
+                                                       with_tables, without_tables - with_tables))
@@ -0,0 +1,77 @@
+import sys
+import tracemalloc
+
+from config import parser
+from benchmarks import node_state
+from lang.astnode import ASTNode
+import datasets.hs
+import datasets.django
+
+
+class DictNode(object):
+    """
+    node layout before the node classes had slots, every attribute in the __dict__ of the node
+    """
+
+
+def dict_node_bytes(node):
+    dict_node = DictNode()
+    dict_node.__dict__.update(node_state(node))
+    return sys.getsizeof(dict_node) + sys.getsizeof(dict_node.__dict__)
+
+
+def dataset_nodes(dataset):
+    """
+    :return: the distinct nodes of the code trees and of the rules of the actions of a dataset
+    """
+    nodes = dict()
+    for code_tree in dataset.code_trees:
+        if code_tree is not None:
+            nodes.update((id(node), node) for node in code_tree.nodes)
+    for actions in dataset.actions:
+        for action in actions or []:
+            for key in ['rule', 'parent_rule']:
+                rule = action.data.get(key)
+                if isinstance(rule, ASTNode):
+                    nodes.update((id(node), node) for node in rule.nodes)
+    return list(nodes.values())
+
+
+def node_report(nodes):
+    """
+    :return: bytes of the node objects with slots and as they took with a __dict__, without the shared values
+    """
+    # the layouts depend on the class of a node only
+    slot_sizes, dict_sizes = dict(), dict()
+    slot_bytes, dict_bytes = 0, 0
+    for node in nodes:
+        cls = type(node)
+        if cls not in slot_sizes:
+            slot_sizes[cls] = sys.getsizeof(node)
+            dict_sizes[cls] = dict_node_bytes(node)
+        slot_bytes += slot_sizes[cls]
+        dict_bytes += dict_sizes[cls]
+    return slot_bytes, dict_bytes
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    args.cuda = False
+    mb = 1024 * 1024
+
+    for name, load_dataset in [('HS', datasets.hs.load_dataset), ('Django', datasets.django.load_dataset)]:
+        for unary_closures in [False, True]:
+            args.unary_closures = unary_closures
+            tracemalloc.start()
+            splits = load_dataset(args)
+            loaded_bytes = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+
+            print("{}{} datasets: {:.1f} MB allocated while loading".format(
+                name, ' with unary closures' if unary_closures else '', loaded_bytes / mb))
+            for split_name, dataset in zip(['train', 'dev', 'test'], splits):
+                nodes = dataset_nodes(dataset)
+                slot_bytes, dict_bytes = node_report(nodes)
+                print("{}: {} nodes, {:.1f} MB with slots, {:.1f} MB with __dict__, {:.1f} MB saved".format(
+                    split_name, len(nodes), slot_bytes / mb, dict_bytes / mb, (dict_bytes - slot_bytes) / mb))
+            del splits
@@ -0,0 +1,242 @@
+import copyreg
+import gc
+import io
+import pickle
+import sys
+import time
+import torch
+
+from config import parser
+from benchmarks import node_state
+import lang.astnode as astnode
+from lang.astnode import ASTNode, DecodeTree, Rule, invalidate_hashes
+from lang.parse import parse_tree_to_python_ast, python_ast_node
+from lang.unaryclosure import compressed_ast_to_normal, decompress_node
+from model.encoder import ChildSumTreeLSTM
+from model.utils import init_var
+import datasets.hs
+import datasets.django
+
+
+# recursive traversals as they were before the explicit stacks, for comparison
+
+def size_recursive(node):
+    return 1 + sum([size_recursive(child) for child in node.children])
+
+
+def nodes_recursive(node):
+    yield node
+    for child in node.children:
+        for child_n in nodes_recursive(child):
+            yield child_n
+
+
+def copy_recursive(node):
+    new_node = node.copy_node()
+    for child in node.children:
+        new_node.add_child(copy_recursive(child))
+    return new_node
+
+
+def get_leaves_recursive(node):
+    if node.is_leaf:
+        return [node]
+    leaves = []
+    for child in node.children:
+        leaves.extend(get_leaves_recursive(child))
+    return leaves
+
+
+def hash_recursive(node):
+    if node._hash_epoch == astnode.hash_epoch:
+        return node._hash
+
+    code = hash(node.type)
+    if node.label is not None:
+        code = code * 37 + hash(node.label)
+    if node.value is not None:
+        code = code * 37 + hash(node.value)
+    for child in node.children:
+        code = code * 37 + hash_recursive(child)
+
+    code = hash(code)
+    object.__setattr__(node, '_hash', code)
+    object.__setattr__(node, '_hash_epoch', astnode.hash_epoch)
+    return code
+
+
+def hash_recursive_fresh(node):
+    # every node is hashed again
+    invalidate_hashes()
+    return hash_recursive(node)
+
+
+def hash_iterative(node):
+    # every node is hashed again
+    invalidate_hashes()
+    return hash(node)
+
+
+def parse_tree_to_python_ast_recursive(tree):
+    sub_trees = []
+    ast_node = python_ast_node(tree, sub_trees)
+    for sub_tree, target, key in sub_trees:
+        sub_ast = parse_tree_to_python_ast_recursive(sub_tree)
+        if isinstance(key, int):
+            target[key] = sub_ast
+        else:
+            setattr(target, key, sub_ast)
+    return ast_node
+
+
+def compressed_ast_to_normal_recursive(parse_tree):
+    children = []
+    decompress_node(parse_tree, children)
+    for child in reversed(children):
+        compressed_ast_to_normal_recursive(child)
+
+
+def reduce_node_recursive(node):
+    # every node is pickled on its own, pickle recurses through its children
+    return copyreg.__newobj__, (type(node),), node_state(node)
+
+
+def pickle_recursive(tree):
+    f = io.BytesIO()
+    pickler = pickle.Pickler(f, pickle.HIGHEST_PROTOCOL)
+    pickler.dispatch_table = copyreg.dispatch_table.copy()
+    for node_class in [ASTNode, DecodeTree, Rule]:
+        pickler.dispatch_table[node_class] = reduce_node_recursive
+    pickler.dump(tree)
+    return pickle.loads(f.getvalue())
+
+
+def pickle_iterative(tree):
+    return pickle.loads(pickle.dumps(tree, pickle.HIGHEST_PROTOCOL))
+
+
+def deep_tree(depth):
+    """
+    :return: a chain of depth nodes, deeper than the recursion limit
+    """
+    root = node = ASTNode('root')
+    for i in range(depth - 1):
+        child = ASTNode('node', label=str(i % 10))
+        node.add_child(child)
+        node = child
+    return root
+
+
+def tree_size_recursive(tree):
+    if hasattr(tree, '_size'):
+        return tree._size
+    tree._size = 1 + sum([tree_size_recursive(child) for child in tree.children])
+    return tree._size
+
+
+def clear_sizes(tree):
+    """
+    drops the memoized sizes of the nodes, so that the size of the tree is counted again
+    """
+    for node in tree.data():
+        node.__dict__.pop('_size', None)
+    return tree
+
+
+def forward_inner_recursive(cell, tree, Xi, Xf, Xu, Xo, dr_H, states):
+    for child in tree.children:
+        forward_inner_recursive(cell, child, Xi, Xf, Xu, Xo, dr_H, states)
+
+    if tree.num_children == 0:
+        child_c = init_var(1, cell.mem_dim, cuda=Xi.is_cuda, scale=0.1, training=cell.training)
+        child_h = init_var(1, cell.mem_dim, cuda=Xi.is_cuda, scale=0.1, training=cell.training)
+    else:
+        child_c, child_h = zip(*map(lambda x: states[x.idx], tree.children))
+        child_c, child_h = torch.cat(child_c, dim=0), torch.cat(child_h, dim=0)
+
+    states[tree.idx] = cell.node_forward(Xi[tree.idx, :], Xf[tree.idx, :], Xo[tree.idx, :], Xu[tree.idx, :],
+                                         child_c, child_h, dr_H)
+    return states[tree.idx]
+
+
+def throughput(traversal, items):
+    """
+    :return: items traversed per second
+    """
+    # garbage of the previous runs is not collected on the time of this one
+    gc.collect()
+    start = time.perf_counter()
+    for item in items:
+        traversal(item)
+    return len(items) / (time.perf_counter() - start)
+
+
+def report(name, recursive, iterative, items, repeat, prepare=None):
+    """
+    prints the best throughput of both traversals out of repeat runs, prepare makes fresh copies
+    of the items for the traversals which modify them
+    """
+    rates = []
+    for traversal in [recursive, iterative]:
+        rates.append(max([throughput(traversal, [prepare(item) for item in items] if prepare else items)
+                          for _ in range(repeat)]))
+    print("{}: recursive {:.0f} trees/s, iterative {:.0f} trees/s, {:.2f}x".format(name, rates[0], rates[1],
+                                                                                  rates[1] / rates[0]))
+
+
+def encoder_inputs(cell, tree):
+    X = torch.randn(tree.size(), cell.in_dim)
+    dr_H = torch.ones(4, cell.mem_dim)
+    return tree, cell.ix(X), cell.fx(X), cell.ux(X), cell.ox(X), dr_H
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    args.cuda = False
+    repeat = 5
+
+    # round trip of a tree much deeper than the default recursion limit
+    tree = deep_tree(20000)
+    start = time.perf_counter()
+    tree_copy = pickle_iterative(tree)
+    print("Pickle round trip of a tree of depth {} at recursion limit {}: {:.0f} ms".format(
+        tree.size, sys.getrecursionlimit(), (time.perf_counter() - start) * 1000))
+    assert tree_copy == tree and tree_copy.parent is None
+
+    # only the recursive traversals need it
+    sys.setrecursionlimit(50000)
+
+    for name, load_dataset in [('HS', datasets.hs.load_dataset), ('Django', datasets.django.load_dataset)]:
+        train, _, _ = load_dataset(args)
+        code_trees = [tree for tree in train.code_trees if tree is not None]
+        query_trees = [tree for tree in train.query_trees if tree is not None]
+        normal_trees = []
+        for tree in code_trees:
+            normal_tree = tree.copy()
+            compressed_ast_to_normal(normal_tree)
+            normal_trees.append(normal_tree)
+
+        print("{} train set traversals ({} code trees, {} query trees):".format(name, len(code_trees),
+                                                                               len(query_trees)))
+        report('ASTNode.size', size_recursive, lambda tree: tree.size, code_trees, repeat)
+        report('ASTNode.nodes', lambda tree: list(nodes_recursive(tree)), lambda tree: list(tree.nodes),
+               code_trees, repeat)
+        report('ASTNode.copy', copy_recursive, lambda tree: tree.copy(), code_trees, repeat)
+        report('ASTNode.get_leaves', get_leaves_recursive, lambda tree: tree.get_leaves(), code_trees, repeat)
+        report('ASTNode.__hash__', hash_recursive_fresh, hash_iterative, code_trees, repeat)
+        report('ASTNode pickle round trip', pickle_recursive, pickle_iterative, code_trees, repeat)
+        report('parse_tree_to_python_ast', parse_tree_to_python_ast_recursive, parse_tree_to_python_ast,
+               normal_trees, repeat)
+        report('compressed_ast_to_normal', compressed_ast_to_normal_recursive, compressed_ast_to_normal,
+               code_trees, repeat, prepare=lambda tree: tree.copy())
+        report('Tree.size', lambda tree: tree_size_recursive(clear_sizes(tree)),
+               lambda tree: clear_sizes(tree).size(), query_trees, repeat)
+
+        cell = ChildSumTreeLSTM(args.word_embed_dim, args.encoder_hidden_dim)
+        cell.eval()
+        with torch.no_grad():
+            inputs = [encoder_inputs(cell, tree) for tree in query_trees]
+            report('ChildSumTreeLSTM.forward_inner',
+                   lambda x: forward_inner_recursive(cell, *x, states=[None] * len(x[1])),
+                   lambda x: cell.forward_inner(*x, states=[None] * len(x[1])),
+                   inputs, repeat)
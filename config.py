@@ -29,6 +29,10 @@ parser.add_argument('-freeze_embeds', dest='freeze_embeds', action='store_true')
 parser.add_argument('-no_freeze_embeds', dest='freeze_embeds', action='store_false')
 parser.set_defaults(freeze_embeds=False)
 parser.add_argument('-encoder_dropout', default=0.2, type=float)
+# evaluate all nodes of the same height in the batch at once instead of node by node recursion
+parser.add_argument('-level_batching', dest='level_batching', action='store_true')
+parser.add_argument('-no_level_batching', dest='level_batching', action='store_false')
+parser.set_defaults(level_batching=True)
 
 # decoder
 parser.add_argument('-parent_hidden_state_feed', dest='parent_hidden_state_feed', action='store_true')
@@ -71,12 +75,40 @@ parser.add_argument('-lr', default=0.001, type=float)
 parser.add_argument('-cuda', dest='cuda', action='store_true')
 parser.add_argument('-no_cuda', dest='cuda', action='store_false')
 parser.add_argument('-valid_metric', default='bleu')
+# batch examples of similar query tree size and action count together
+parser.add_argument('-bucket_batching', dest='bucket_batching', action='store_true')
+parser.add_argument('-no_bucket_batching', dest='bucket_batching', action='store_false')
+parser.set_defaults(bucket_batching=False)
+parser.add_argument('-bucket_tree_width', default=5, type=int)
+parser.add_argument('-bucket_action_width', default=20, type=int)
 
 # decoding
+# greedy and sample decode one hypothesis per example without the beam search
+parser.add_argument('-decode_mode', default='beam', choices=['beam', 'greedy', 'sample'])
+# sampling from the sample_top_k most probable actions (0 for all of them)
+# and from the smallest set of the most probable actions with a total probability of sample_top_p
+parser.add_argument('-sample_top_k', default=0, type=int)
+parser.add_argument('-sample_top_p', default=1.0, type=float)
 parser.add_argument('-beam_size', default=10, type=int)
+# number of examples decoded at once in validation
+parser.add_argument('-decode_batch_size', default=10, type=int)
+# memory limit in megabytes of the cached encodings of decoded examples (0 disables the cache)
+parser.add_argument('-encoder_cache_mb', default=0., type=float)
+# forked worker processes decoding the validation set, cpu only
+parser.add_argument('-valid_workers', default=1, type=int)
 parser.add_argument('-decode_max_time_step', default=200, type=int)
+# beam search of an example stops when no live hypothesis can become the best completed one (top1)
+# or get ahead of any completed one (all)
+parser.add_argument('-beam_stop', default='none', choices=['none', 'top1', 'all'])
+# seconds of beam search of an example before it stops with the hypotheses completed so far (0 for no budget)
+parser.add_argument('-decode_time_budget', default=0., type=float)
 parser.add_argument('-max_example_action_num', default=200, type=int)
 
 parser.add_argument('-head_nt_constraint', dest='head_nt_constraint', action='store_true')
 parser.add_argument('-no_head_nt_constraint', dest='head_nt_constraint', action='store_false')
-parser.set_defaults(head_nt_constraint=True)
\ No newline at end of file
+parser.set_defaults(head_nt_constraint=True)
+
+# with head_nt_constraint: rule probabilities are normalized over the rules of the frontier node type only
+parser.add_argument('-constrained_rule_softmax', dest='constrained_rule_softmax', action='store_true')
+parser.add_argument('-no_constrained_rule_softmax', dest='constrained_rule_softmax', action='store_false')
+parser.set_defaults(constrained_rule_softmax=False)
\ No newline at end of file
@@ -1,4 +1,3 @@
-from copy import deepcopy
 import torch.utils.data as data
 import torch
 import os
@@ -45,29 +44,45 @@ class Dataset(data.Dataset):
         return self.size
 
     def __getitem__(self, index):
-        data_entry = deepcopy(self.data_entries[index])
+        # shallow copy, entries are only read, the query is replaced by its padded version
+        data_entry = dict(self.data_entries[index])
         data_entry['query'] = self.fix_seq_length_one(data_entry['query'], data_entry['query_tree'].size(), Constants.PAD)
 
         return data_entry
 
     def get_batch(self, indices):
         data_entries = [self.data_entries[index] for index in indices]
-        trees = [deepcopy(data_entry['query_tree']) for data_entry in data_entries]
+        trees = [data_entry['query_tree'] for data_entry in data_entries]
         queries = [data_entry['query'] for data_entry in data_entries]
         max_tree_length = max([tree.size() for tree in trees])
 
         queries = torch.stack(self.fix_seq_length(queries, max_tree_length, Constants.PAD))
 
-        tgt_node_seq = self.tgt_node_seq[indices]
-        tgt_par_rule_seq = self.tgt_par_rule_seq[indices]
-        tgt_par_t_seq = self.tgt_par_t_seq[indices]
-        tgt_action_seq = self.tgt_action_seq[indices]
-        tgt_action_seq_type = self.tgt_action_seq_type[indices]
+        # targets are cut to the longest action sequence of the batch,
+        # the decoder is unrolled only for as many steps as the target has
+        max_action_length = int(self.action_lengths[indices].max())
+
+        tgt_node_seq = self.tgt_node_seq[indices, :max_action_length]
+        tgt_par_rule_seq = self.tgt_par_rule_seq[indices, :max_action_length]
+        tgt_par_t_seq = self.tgt_par_t_seq[indices, :max_action_length]
+        tgt_action_seq = self.tgt_action_seq[indices, :max_action_length]
+        tgt_action_seq_type = self.tgt_action_seq_type[indices, :max_action_length]
 
         return trees, queries, \
                tgt_node_seq, tgt_par_rule_seq, tgt_par_t_seq, \
                tgt_action_seq, tgt_action_seq_type
 
+    def get_decode_batch(self, indices):
+        """
+        :return: data entries of the examples, their query trees and queries padded to the largest tree
+        """
+        data_entries = [self[index] for index in indices]
+        trees = [data_entry['query_tree'] for data_entry in data_entries]
+        max_tree_length = max([tree.size() for tree in trees])
+        queries = torch.stack(self.fix_seq_length([data_entry['query'] for data_entry in data_entries],
+                                                  max_tree_length, Constants.PAD))
+        return data_entries, trees, queries
+
     def fix_seq_length(self, seqns, max_size, pad_item):
         ls = []
         for seq in seqns:
@@ -147,22 +162,24 @@ class Dataset(data.Dataset):
                 self.actions.append(None)
                 continue
 
-            rule_list, rule_parents = code_tree.get_productions(include_value_node=True)
-
             actions = []
-            rule_pos_map = dict()
+            # rules in the order of their applications and the first action of every application,
+            # parents are found by their position as equal rules are applied at several positions
+            rules = []
+            rule_pos = []
+
+            for rule, parent_index, _ in code_tree.iter_productions(include_value_node=True):
+                parent_rule = rules[parent_index] if parent_index >= 0 else None
+                rules.append(rule)
+                rule_pos.append(len(actions))
 
-            for rule_count, rule in enumerate(rule_list):
                 if not self.grammar.is_value_node(rule.parent):
                     assert rule.value is None
-                    parent_rule = rule_parents[(rule_count, rule)][0]
                     if parent_rule:
-                        parent_t = rule_pos_map[parent_rule]
+                        parent_t = rule_pos[parent_index]
                     else:
                         parent_t = 0
 
-                    rule_pos_map[rule] = len(actions)
-
                     d = {'rule': rule, 'parent_t': parent_t, 'parent_rule': parent_rule}
                     action = Action(APPLY_RULE, d)
 
@@ -170,8 +187,7 @@ class Dataset(data.Dataset):
                 else:
                     assert rule.is_leaf
 
-                    parent_rule = rule_parents[(rule_count, rule)][0]
-                    parent_t = rule_pos_map[parent_rule]
+                    parent_t = rule_pos[parent_index]
 
                     terminal_val = rule.value
                     terminal_str = str(terminal_val)
@@ -220,16 +236,20 @@ class Dataset(data.Dataset):
         self.tgt_par_t_seq = torch.LongTensor(self.size, max_example_action_num).zero_()
         self.tgt_action_seq = torch.LongTensor(self.size, max_example_action_num, 3).zero_()
         self.tgt_action_seq_type = torch.LongTensor(self.size, max_example_action_num, 3).zero_()
+        self.action_lengths = torch.LongTensor(self.size).zero_()
 
         for eid, data_entry in enumerate(self.data_entries):
             actions = data_entry['actions']
             exg_action_seq = actions[:max_example_action_num]
             assert len(exg_action_seq) > 0
+            self.action_lengths[eid] = len(exg_action_seq)
 
             for t, action in enumerate(exg_action_seq):
+                rule_id = -1
                 if action.act_type == APPLY_RULE:
                     rule = action.data['rule']
-                    self.tgt_action_seq[eid, t, 0] = self.grammar.rule_to_id[rule]
+                    rule_id = self.grammar.rule_to_id[rule]
+                    self.tgt_action_seq[eid, t, 0] = rule_id
                     self.tgt_action_seq_type[eid, t, 0] = 1
                 elif action.act_type == GEN_TOKEN:
                     token = action.data['literal']
@@ -255,7 +275,11 @@ class Dataset(data.Dataset):
                 # parent information
                 rule = action.data['rule']
                 parent_rule = action.data['parent_rule']
-                self.tgt_node_seq[eid, t] = self.grammar.get_node_type_id(rule.parent)
+                if rule_id >= 0:
+                    self.tgt_node_seq[eid, t] = int(self.grammar.tables.rule_lhs[rule_id])
+                else:
+                    # rules of value nodes are not part of the grammar
+                    self.tgt_node_seq[eid, t] = self.grammar.get_node_type_id(rule.parent)
                 if parent_rule:
                     self.tgt_par_rule_seq[eid, t] = self.grammar.rule_to_id[parent_rule]
                 else:
@@ -266,7 +290,14 @@ class Dataset(data.Dataset):
                 parent_t = action.data['parent_t']
                 self.tgt_par_t_seq[eid, t] = parent_t
 
+    def prepare_action_lengths(self):
+        # every action has at least one of its types set, padding steps have none
+        self.action_lengths = (self.tgt_action_seq_type.sum(2) > 0).long().sum(1)
+
     def prepare_torch(self, cuda):
+        # datasets cached before action lengths were recorded
+        if not hasattr(self, 'action_lengths'):
+            self.prepare_action_lengths()
         if cuda:
             for data_entry in self.data_entries:
                 data_entry["query"] = data_entry["query"].cuda()
@@ -275,6 +306,7 @@ class Dataset(data.Dataset):
             self.tgt_par_t_seq = self.tgt_par_t_seq.cuda()
             self.tgt_action_seq = self.tgt_action_seq.cuda()
             self.tgt_action_seq_type = self.tgt_action_seq_type.cuda()
+            self.action_lengths = self.action_lengths.cuda()
 
     def prepare_data_entries(self):
         data_entries = []
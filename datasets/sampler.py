@@ -0,0 +1,54 @@
+import numpy as np
+
+from utils.general import get_batches
+
+
+class BucketBatchSampler(object):
+    """
+    groups examples of similar query tree size and action count into the same batches,
+    so that a batch does not pay for the padding up to a much longer example.
+    Buckets are keyed on (tree size // tree_width, action count // action_width),
+    examples are shuffled inside the buckets and the batches across the buckets.
+    """
+    def __init__(self, dataset, batch_size, tree_width, action_width):
+        self.batch_size = batch_size
+        self.tree_sizes = np.array([data_entry['query_tree'].size() for data_entry in dataset.data_entries])
+        self.action_lengths = dataset.action_lengths.cpu().numpy()
+
+        keys = np.stack([self.tree_sizes // tree_width, self.action_lengths // action_width], axis=1)
+        # (example_num), bucket id of every example
+        _, self.bucket_ids = np.unique(keys, axis=0, return_inverse=True)
+        self.bucket_ids = self.bucket_ids.reshape(-1)
+        self.bucket_num = self.bucket_ids.max() + 1
+
+    def batches(self):
+        """
+        :return: list of numpy arrays with example indices, a new random order on every call
+        """
+        batches = []
+        leftovers = []
+        for bucket_id in np.random.permutation(self.bucket_num):
+            bucket = np.random.permutation(np.nonzero(self.bucket_ids == bucket_id)[0])
+            full_size = len(bucket) - len(bucket) % self.batch_size
+            batches.extend(get_batches(bucket[:full_size], self.batch_size))
+            leftovers.append(bucket[full_size:])
+
+        # examples which do not fill a batch in their bucket are batched with their closest neighbours
+        leftovers = np.concatenate(leftovers)
+        leftovers = leftovers[np.lexsort((self.action_lengths[leftovers], self.tree_sizes[leftovers]))]
+        batches.extend(get_batches(leftovers, self.batch_size))
+
+        return [batches[i] for i in np.random.permutation(len(batches))]
+
+    def padding_waste(self, batches):
+        """
+        :return: share of padded positions among all query tree and action positions of the batches
+        """
+        real, padded = 0, 0
+        for batch in batches:
+            batch = np.asarray(batch)
+            tree_sizes = self.tree_sizes[batch]
+            action_lengths = self.action_lengths[batch]
+            real += tree_sizes.sum() + action_lengths.sum()
+            padded += len(batch) * (tree_sizes.max() + action_lengths.max())
+        return 1.0 - real / padded
@@ -1,12 +1,31 @@
 from collections import namedtuple
 import pickle
+import sys
 from collections import Iterable, OrderedDict, defaultdict
 from io import StringIO
 
 from lang.util import typename
 
+# attributes which the hash of a node depends on, besides its children
+HASHED_ATTRIBUTES = {'type', 'label', 'value'}
+# advances on every change of a node which was hashed once, which drops all the memoized hashes.
+# the nodes of a tree are hashed together with its root, so the trees containing a changed node
+# are found this way even when the parent of the node is not the tree containing it.
+# not a class attribute, changing one slows down the attribute access of all the nodes
+hash_epoch = 0
+# range of the hashes python keeps as __hash__ returns them
+HASH_MIN, HASH_MAX = -sys.maxsize - 1, sys.maxsize
+
+
 class ASTNode(object):
+    # no __dict__ for the nodes, datasets keep millions of them.
+    # _hash is the memoized hash, None until the hash of the node is computed for the first time,
+    # it is valid while hash_epoch is still the _hash_epoch it was computed in
+    __slots__ = ('type', 'label', 'value', 'parent', 'children', '_hash', '_hash_epoch')
+
     def __init__(self, node_type, label=None, value=None, children=None):
+        _set_hash(self, None)
+        _set_hash_epoch(self, -1)
         self.type = node_type
         self.label = label
         self.value = value
@@ -37,82 +56,162 @@ class ASTNode(object):
 
     @property
     def size(self):
-        if self.is_leaf:
-            return 1
-
-        node_num = 1
-        for child in self.children:
-            node_num += child.size
+        node_num = 0
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            node_num += 1
+            stack.extend(node.children)
 
         return node_num
 
     @property
     def nodes(self):
-        """a generator that returns all the nodes"""
+        """a generator that returns all the nodes in depth-first, left-to-right order"""
 
-        yield self
-        for child in self.children:
-            for child_n in child.nodes:
-                yield child_n
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            yield node
+            stack.extend(reversed(node.children))
 
     @property
     def as_type_node(self):
-        """return an ASTNode with type information only"""
-        return ASTNode(self.type)
+        """return an ASTNode with type information only, interned for every type, so it must not be modified"""
+        type_node = _type_nodes.get(self.type)
+        if type_node is None:
+            type_node = _type_nodes[self.type] = ASTNode(self.type)
+        return type_node
 
     def __repr__(self):
-        repr_str = ''
-        # if not self.is_leaf:
-        repr_str += '('
+        repr_str = []
+        # nodes to print, None closes the parenthesis of a node after its children
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if node is None:
+                repr_str.append(')')
+                continue
 
-        repr_str += typename(self.type)
+            if node is not self:
+                repr_str.append(' ')
+            # if not self.is_leaf:
+            repr_str.append('(')
 
-        if self.label is not None:
-            repr_str += '{%s}' % self.label
+            repr_str.append(typename(node.type))
 
-        if self.value is not None:
-            repr_str += '{val=%s}' % self.value
+            if node.label is not None:
+                repr_str.append('{%s}' % node.label)
+
+            if node.value is not None:
+                repr_str.append('{val=%s}' % node.value)
 
-        # if not self.is_leaf:
-        for child in self.children:
-            repr_str += ' ' + child.__repr__()
-        repr_str += ')'
+            # if not self.is_leaf:
+            stack.append(None)
+            stack.extend(reversed(node.children))
 
-        return repr_str
+        return ''.join(repr_str)
 
     def __hash__(self):
-        code = hash(self.type)
-        if self.label is not None:
-            code = code * 37 + hash(self.label)
-        if self.value is not None:
-            code = code * 37 + hash(self.value)
-        for child in self.children:
-            code = code * 37 + hash(child)
+        epoch = hash_epoch
+        if self._hash_epoch == epoch:
+            return self._hash
+
+        # the nodes without a valid memoized hash in pre-order, they are hashed in reverse,
+        # so every node after its children
+        nodes = [self]
+        for node in nodes:
+            for child in node.children:
+                if child._hash_epoch != epoch:
+                    nodes.append(child)
+
+        for node in reversed(nodes):
+            code = hash(node.type)
+            if node.label is not None:
+                code = code * 37 + hash(node.label)
+            if node.value is not None:
+                code = code * 37 + hash(node.value)
+            for child in node.children:
+                code = code * 37 + child._hash
+
+            # reduced as python reduces the values returned by __hash__, so parents can use it as it is
+            if not HASH_MIN <= code <= HASH_MAX:
+                code = hash(code)
+            elif code == -1:
+                code = -2
+            _set_hash(node, code)
+            _set_hash_epoch(node, epoch)
+
+        return self._hash
+
+    def __setattr__(self, name, value):
+        if name in HASHED_ATTRIBUTES:
+            self.invalidate_hash()
+        object.__setattr__(self, name, value)
+
+    def __reduce__(self):
+        """
+        the tree is pickled as the flat pre-order list of its nodes, so pickling does not recurse
+        through the children. Every node is (class, type, label, value, number of children, values of
+        the slots of the subclass), the memoized hashes are not pickled as hashes of strings differ
+        between processes. The root of the pickled tree has no parent when it is loaded
+        """
+        nodes = []
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            node_class = type(node)
+            extra = tuple([slot.__get__(node) for _, slot in subclass_slot_descriptors(node_class)])
+            nodes.append((node_class, node.type, node.label, node.value, len(node.children), extra))
+            stack.extend(reversed(node.children))
+
+        return build_tree, (nodes,)
+
+    def __setstate__(self, state):
+        """
+        loads the nodes pickled before the trees were pickled as flat lists of nodes
+        :param state: slot values, or the __dict__ of a node pickled before the nodes had slots
+        """
+        _set_hash(self, None)
+        _set_hash_epoch(self, -1)
+        for name, slot in slot_descriptors(type(self)):
+            if name in state and name not in ('_hash', '_hash_epoch'):
+                slot.__set__(self, state[name])
 
-        return code
+    def invalidate_hash(self):
+        """
+        drops the memoized hashes before a change of the node, nodes which were never hashed
+        are not part of any hashed tree and change for free
+        """
+        if self._hash is not None:
+            invalidate_hashes()
 
     def __eq__(self, other):
-        if not isinstance(other, self.__class__):
-            return False
-        if hash(self) != hash(other):
-            return False
-
-        if self.type != other.type:
-            return False
+        # pairs of nodes at the same position in both trees
+        stack = [(self, other)]
+        while stack:
+            node, other = stack.pop()
+            if node is other:
+                continue
+            if not isinstance(other, node.__class__):
+                return False
+            if hash(node) != hash(other):
+                return False
 
-        if self.label != other.label:
-            return False
+            if node.type != other.type:
+                return False
 
-        if self.value != other.value:
-            return False
+            if node.label != other.label:
+                return False
 
-        if len(self.children) != len(other.children):
-            return False
+            if node.value != other.value:
+                return False
 
-        for i in range(len(self.children)):
-            if self.children[i] != other.children[i]:
+            if len(node.children) != len(other.children):
                 return False
 
+            stack.extend(zip(node.children, other.children))
+
         return True
 
     def __ne__(self, other):
@@ -126,14 +225,19 @@ class ASTNode(object):
         if tgt_child:
             assert len(tgt_child) == 1, 'unsafe deletion for more than one children'
             tgt_child = tgt_child[0]
-            self.children.remove(tgt_child)
+            self.remove_child(tgt_child)
         else:
             raise KeyError
 
     def add_child(self, child):
+        self.invalidate_hash()
         child.parent = self
         self.children.append(child)
 
+    def remove_child(self, child):
+        self.invalidate_hash()
+        self.children.remove(child)
+
     def get_child_id(self, child):
         for i, _child in enumerate(self.children):
             if child == _child:
@@ -148,38 +252,47 @@ class ASTNode(object):
         return sb.getvalue()
 
     def pretty_print_helper(self, sb, depth, new_line=False):
-        if new_line:
-            sb.write('\n')
-            for i in range(depth): sb.write(' ')
-
-        sb.write('(')
-        sb.write(typename(self.type))
-        if self.label is not None:
-            sb.write('{%s}' % self.label)
-
-        if self.value is not None:
-            sb.write('{val=%s}' % self.value)
-
-        if len(self.children) == 0:
-            sb.write(')')
-            return
-
-        sb.write(' ')
-        new_line = True
-        for child in self.children:
-            child.pretty_print_helper(sb, depth + 2, new_line)
-
-        sb.write('\n')
-        for i in range(depth): sb.write(' ')
-        sb.write(')')
+        # (node, depth, new_line) of the nodes to print, node None closes the parenthesis
+        # of a node of that depth after its children
+        stack = [(self, depth, new_line)]
+        while stack:
+            node, depth, new_line = stack.pop()
+            if node is None:
+                sb.write('\n')
+                for i in range(depth): sb.write(' ')
+                sb.write(')')
+                continue
+
+            if new_line:
+                sb.write('\n')
+                for i in range(depth): sb.write(' ')
+
+            sb.write('(')
+            sb.write(typename(node.type))
+            if node.label is not None:
+                sb.write('{%s}' % node.label)
+
+            if node.value is not None:
+                sb.write('{val=%s}' % node.value)
+
+            if len(node.children) == 0:
+                sb.write(')')
+                continue
+
+            sb.write(' ')
+            stack.append((None, depth, False))
+            for child in reversed(node.children):
+                stack.append((child, depth + 2, True))
 
     def get_leaves(self):
-        if self.is_leaf:
-            return [self]
-
         leaves = []
-        for child in self.children:
-            leaves.extend(child.get_leaves())
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if node.children:
+                stack.extend(reversed(node.children))
+            else:
+                leaves.append(node)
 
         return leaves
 
@@ -203,57 +316,66 @@ class ASTNode(object):
         """
         rule_list = list()
         rule_parents = OrderedDict()
-        node_rule_map = dict()
-        s = list()
-        s.append(self)
+
+        for rule_num, (rule, parent_index, child_index) in enumerate(self.iter_productions(include_value_node)):
+            rule_list.append(rule)
+            if parent_index >= 0:
+                rule_parents[(rule_num, rule)] = (rule_list[parent_index], child_index)
+            else:
+                rule_parents[(rule_num, rule)] = (None, -1)
+
+        return rule_list, rule_parents
+
+    def iter_productions(self, include_value_node=False):
+        """
+        streams the depth-first, left-to-right sequence of rule applications as tuples
+        (rule, parent_index, child_index): the interned rule, the position of the rule application
+        of the parent node in the sequence (-1 for the root) and the position of the node among the
+        children of its parent. Child positions are tracked during the traversal instead of searched for
+        """
+        # nodes waiting for their rule application with their parent_index and child_index
+        s = [(self, -1, -1)]
         rule_num = 0
 
         while len(s) > 0:
-            node = s.pop()
-            for child in reversed(node.children):
-                if not child.is_leaf:
-                    s.append(child)
-                elif include_value_node:
-                    if child.value is not None:
-                        s.append(child)
+            node, parent_index, child_index = s.pop()
 
             # only non-terminals and terminal nodes holding values
             # can form a production rule
-            if node.children or node.value is not None:
-                rule = Rule(node.type)
-                if include_value_node:
-                    rule.value = node.value
-
-                for c in node.children:
-                    val = None
-                    child = ASTNode(c.type, c.label, val)
-                    rule.add_child(child)
-
-                rule_list.append(rule)
-                if node.parent:
-                    child_id = node.parent.get_child_id(node)
-                    parent_rule = node_rule_map[node.parent]
-                    rule_parents[(rule_num, rule)] = (parent_rule, child_id)
-                else:
-                    rule_parents[(rule_num, rule)] = (None, -1)
-                rule_num += 1
-
-                node_rule_map[node] = rule
+            if not node.children and node.value is None:
+                continue
 
-        return rule_list, rule_parents
+            yield production_rule(node, include_value_node), parent_index, child_index
 
-    def copy(self):
-        new_tree = ASTNode(self.type, self.label, self.value)
-        if self.is_leaf:
-            return new_tree
+            for i in range(len(node.children) - 1, -1, -1):
+                child = node.children[i]
+                if not child.is_leaf or (include_value_node and child.value is not None):
+                    s.append((child, rule_num, i))
+            rule_num += 1
 
-        for child in self.children:
-            new_tree.add_child(child.copy())
+    def copy(self):
+        new_tree = self.copy_node()
+        # nodes with their copies, which get copies of their children
+        stack = [(self, new_tree)]
+        while stack:
+            node, new_node = stack.pop()
+            for child in node.children:
+                new_child = child.copy_node()
+                new_node.add_child(new_child)
+                stack.append((child, new_child))
 
         return new_tree
 
+    def copy_node(self):
+        """
+        copy of the node without its children
+        """
+        return ASTNode(self.type, self.label, self.value)
+
 
 class DecodeTree(ASTNode):
+    __slots__ = ('t', 'applied_rule')
+
     def __init__(self, node_type, label=None, value=None, children=None, t=-1):
         super(DecodeTree, self).__init__(node_type, label, value, children)
 
@@ -262,19 +384,16 @@ class DecodeTree(ASTNode):
         # record the ApplyRule action that is used to expand the current node
         self.applied_rule = None
 
-    def copy(self):
-        new_tree = DecodeTree(self.type, self.label, value=self.value, t=self.t)
-        new_tree.applied_rule = self.applied_rule
-        if self.is_leaf:
-            return new_tree
-
-        for child in self.children:
-            new_tree.add_child(child.copy())
-
-        return new_tree
+    def copy_node(self):
+        new_node = DecodeTree(self.type, self.label, value=self.value, t=self.t)
+        new_node.applied_rule = self.applied_rule
+        return new_node
 
 
 class Rule(ASTNode):
+    # the parent slot stays unset, the parent of a rule is its type node
+    __slots__ = ()
+
     def __init__(self, *args, **kwargs):
         super(Rule, self).__init__(*args, **kwargs)
 
@@ -293,4 +412,126 @@ class Rule(ASTNode):
         if self.value is not None:
             parent += '{val=%s}' % self.value
 
-        return '%s -> %s' % (parent, ', '.join([repr(c) for c in self.children]))
\ No newline at end of file
+        return '%s -> %s' % (parent, ', '.join([repr(c) for c in self.children]))
+
+
+# setters of the slots of the memoized hash, faster than object.__setattr__ which finds them by name
+_set_hash = ASTNode._hash.__set__
+_set_hash_epoch = ASTNode._hash_epoch.__set__
+# setters of the slots the trees are rebuilt with
+_set_type = ASTNode.type.__set__
+_set_label = ASTNode.label.__set__
+_set_value = ASTNode.value.__set__
+_set_parent = ASTNode.parent.__set__
+_set_children = ASTNode.children.__set__
+
+
+def invalidate_hashes():
+    """
+    drops the memoized hashes of all the nodes
+    """
+    global hash_epoch
+    hash_epoch += 1
+
+
+def slot_descriptors(node_class):
+    """
+    :return: list of (name, descriptor) of the slots of a node class and its base classes
+    """
+    descriptors = _slot_descriptors.get(node_class)
+    if descriptors is None:
+        descriptors = [(name, cls.__dict__[name]) for cls in node_class.__mro__
+                       for name in cls.__dict__.get('__slots__', ())]
+        _slot_descriptors[node_class] = descriptors
+    return descriptors
+
+
+def subclass_slot_descriptors(node_class):
+    """
+    :return: list of (name, descriptor) of the slots a node class adds to the slots of ASTNode
+    """
+    descriptors = _subclass_slot_descriptors.get(node_class)
+    if descriptors is None:
+        descriptors = [(name, slot) for name, slot in slot_descriptors(node_class) if name not in ASTNode.__slots__]
+        _subclass_slot_descriptors[node_class] = descriptors
+    return descriptors
+
+
+def build_tree(nodes):
+    """
+    rebuilds a tree pickled by ASTNode.__reduce__
+    :param nodes: the nodes of the tree in pre-order
+    :return: the root of the tree
+    """
+    root = None
+    # nodes which wait for their children, with the number of their children still missing
+    stack = []
+    for node_class, node_type, label, value, child_num, extra in nodes:
+        node = node_class.__new__(node_class)
+        _set_hash(node, None)
+        _set_hash_epoch(node, -1)
+        _set_type(node, node_type)
+        _set_label(node, label)
+        _set_value(node, value)
+        _set_children(node, [])
+        for (_, slot), slot_value in zip(subclass_slot_descriptors(node_class), extra):
+            slot.__set__(node, slot_value)
+
+        if stack:
+            parent = stack[-1]
+            parent[0].children.append(node)
+            _set_parent(node, parent[0])
+            parent[1] -= 1
+            if parent[1] == 0:
+                stack.pop()
+        else:
+            root = node
+            # the parent slot of a rule stays unset
+            if node_class is not Rule:
+                _set_parent(node, None)
+
+        if child_num > 0:
+            stack.append([node, child_num])
+
+    return root
+
+
+# slot descriptors of the node classes
+_slot_descriptors = dict()
+# slot descriptors the node classes add to the slots of ASTNode
+_subclass_slot_descriptors = dict()
+# node types with their interned type nodes
+_type_nodes = dict()
+# canonical instances of the rules, equal rules from the productions of different trees are the same object
+_interned_rules = dict()
+# interned rules of the productions by (node type, value, types and labels of the children) of their nodes
+_production_rules = dict()
+
+
+def intern_rule(rule, replace=False):
+    """
+    :param replace: makes the rule the canonical instance even if an equal rule is interned already
+    :return: the canonical instance of the rule, which must not be modified
+    """
+    if replace:
+        _interned_rules[rule] = rule
+        # the production rules may be equal to the new canonical instance
+        _production_rules.clear()
+        return rule
+    return _interned_rules.setdefault(rule, rule)
+
+
+def production_rule(node, include_value=False):
+    """
+    :return: the interned rule which expands the node, the rule is built only for the first node of its kind
+    """
+    value = node.value if include_value else None
+    key = (node.type, value, tuple([(child.type, child.label) for child in node.children]))
+    rule = _production_rules.get(key)
+    if rule is None:
+        rule = Rule(node.type)
+        rule.value = value
+        for child in node.children:
+            rule.add_child(ASTNode(child.type, child.label))
+        rule = _production_rules[key] = intern_rule(rule)
+    return rule
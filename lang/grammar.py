@@ -1,10 +1,11 @@
 import ast
 import inspect
+import numpy as np
 from collections import OrderedDict, defaultdict
 import logging
 from tqdm import tqdm
 
-from lang.astnode import ASTNode
+from lang.astnode import ASTNode, intern_rule
 from lang.util import typename
 
 
@@ -45,9 +46,45 @@ class Grammar(object):
 
         for gid, rule in enumerate(rules, start=0):
             self.rule_to_id[rule] = gid
+            # rules of the productions of the trees are the grammar rules themselves, so the lookups
+            # of rule_to_id find them by identity
+            intern_rule(rule, replace=True)
 
         self.id_to_rule = OrderedDict((v, k) for (k, v) in self.rule_to_id.items())
 
+        # pickled with the grammar, so the datasets and models load them with their grammars
+        self.tables = GrammarTables(self)
+        self.prepare_rule_masks()
+
+    def __setstate__(self, state):
+        # grammars pickled while their tables were kept outside the pickle
+        state.pop('_tables', None)
+        self.__dict__.update(state)
+        for rule in self.rules:
+            intern_rule(rule, replace=True)
+        # grammars pickled before the tables were introduced
+        if 'tables' not in state:
+            self.tables = GrammarTables(self)
+        # grammars pickled before the rule masks were introduced
+        if 'rule_id_matrix' not in state:
+            self.prepare_rule_masks()
+
+    def prepare_rule_masks(self):
+        """
+        rules applicable to every node type: node_type_rule_ids[node_type_id] is an array of rule ids
+        in the order of the rules, rule_mask is a (node_num, rule_num) boolean matrix of the same,
+        rule_id_matrix has the arrays as rows padded with 0 to the longest one and rule_counts their lengths
+        """
+        self.rule_mask = np.zeros((len(self.node_type_to_id), len(self.rules)), dtype=bool)
+        self.rule_mask[self.tables.rule_lhs, np.arange(len(self.rules))] = True
+        self.node_type_rule_ids = [self.tables.get_lhs_rules(node_type_id)
+                                   for node_type_id in range(len(self.node_type_to_id))]
+
+        self.rule_counts = self.rule_mask.sum(axis=1)
+        self.rule_id_matrix = np.zeros((len(self.node_type_to_id), max(1, self.rule_counts.max())), dtype=np.int64)
+        for node_type_id, rule_ids in enumerate(self.node_type_rule_ids):
+            self.rule_id_matrix[node_type_id, :len(rule_ids)] = rule_ids
+
     def __iter__(self):
         return self.rules.__iter__()
 
@@ -77,6 +114,50 @@ class Grammar(object):
     def is_value_node(self, node):
         raise NotImplementedError
 
+
+class GrammarTables(object):
+    """
+    integer form of a grammar, node types are numbered as in grammar.node_type_to_id and rules
+    as in grammar.rules, pickled together with the grammar
+    """
+    def __init__(self, grammar):
+        rules = grammar.rules
+        type_num = len(grammar.node_type_to_id)
+
+        # node type of the left hand side of every rule
+        self.rule_lhs = np.array([grammar.get_node_type_id(rule.parent) for rule in rules], dtype=np.int64)
+
+        # right hand sides in CSR form: child node types of rule i are
+        # rule_children[rule_child_offsets[i]:rule_child_offsets[i+1]]
+        self.rule_child_offsets = np.zeros(len(rules) + 1, dtype=np.int64)
+        self.rule_child_offsets[1:] = np.cumsum([len(rule.children) for rule in rules])
+        self.rule_children = np.array([grammar.get_node_type_id(child) for rule in rules for child in rule.children],
+                                      dtype=np.int64)
+
+        # whether the nodes of a type hold values or are terminals, by node type
+        self.value_mask = np.zeros(type_num, dtype=bool)
+        self.terminal_mask = np.zeros(type_num, dtype=bool)
+        for rule in rules:
+            for node in rule.nodes:
+                type_id = grammar.get_node_type_id(node)
+                self.value_mask[type_id] = grammar.is_value_node(node)
+                self.terminal_mask[type_id] = grammar.is_terminal(node)
+
+        # rules of every left hand side in the order of the rules: rules of node type i are
+        # lhs_rules[lhs_rule_offsets[i]:lhs_rule_offsets[i+1]]
+        self.lhs_rules = np.argsort(self.rule_lhs, kind='stable')
+        self.lhs_rule_offsets = np.zeros(type_num + 1, dtype=np.int64)
+        self.lhs_rule_offsets[1:] = np.cumsum(np.bincount(self.rule_lhs, minlength=type_num))
+
+        self.root = np.int64(grammar.get_node_type_id(grammar.root_node))
+
+    def get_rule_children(self, rule_id):
+        return self.rule_children[self.rule_child_offsets[rule_id]:self.rule_child_offsets[rule_id + 1]]
+
+    def get_lhs_rules(self, type_id):
+        return self.lhs_rules[self.lhs_rule_offsets[type_id]:self.lhs_rule_offsets[type_id + 1]]
+
+
 NODE_FIELD_BLACK_LIST = {'ctx'}
 
 TERMINAL_AST_TYPES = {
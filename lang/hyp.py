@@ -2,34 +2,96 @@ from lang.grammar import Grammar
 from lang.astnode import DecodeTree
 
 
+class HypNode(object):
+    """
+    immutable node of the hypotheses, shared between a hypothesis and all its continuations.
+    Pending nodes wait on the expansion stack, expanded nodes are kept only as parents of their children.
+    """
+    __slots__ = ('type', 'label', 'value', 'type_id', 't', 'row', 'rule_id', 'parent')
+
+    def __init__(self, node_type, label=None, value=None, type_id=-1, t=-1, row=None, rule_id=-1, parent=None):
+        self.type = node_type
+        self.label = label
+        self.value = value
+        # node type id in the grammar tables
+        self.type_id = type_id
+        # record the time step when this subtree is created from a rule application
+        self.t = t
+        # history row of the decoder state of that time step
+        self.row = row
+        # record the id of the rule of the ApplyRule action that is used to expand the current node
+        self.rule_id = rule_id
+        self.parent = parent
+
+
 class Hyp:
     def __init__(self, *args):
         if isinstance(args[0], Hyp):
             hyp = args[0]
             self.grammar = hyp.grammar
-            self.tree = hyp.tree.copy()
+            # stack, actions and history are shared with the continued hypothesis
+            self.stack = hyp.stack
+            self.actions = hyp.actions
             self.t = hyp.t
-            self.hist_h = list(hyp.hist_h)
+            self.hist = hyp.hist
             self.log = hyp.log
             self.has_grammar_error = hyp.has_grammar_error
         else:
             assert isinstance(args[0], Grammar)
             grammar = args[0]
             self.grammar = grammar
-            self.tree = DecodeTree(grammar.root_node.type)
+            # nodes waiting for expansion as a linked list (frontier node, rest of the stack),
+            # the first node of the stack is the frontier node
+            self.stack = (HypNode(grammar.root_node.type, type_id=int(grammar.tables.root)), None)
+            # applied actions and history rows of the time steps as linked lists (last item, previous items)
+            self.actions = None
             self.t=-1
-            self.hist_h = []
+            self.hist = None
             self.log = ''
             self.has_grammar_error = False
 
         self.score = 0.0
 
-        self.__frontier_nt = self.tree
-        self.__frontier_nt_t = -1
+        self.__tree = None
 
     def __repr__(self):
         return self.tree.__repr__()
 
+    @property
+    def tree(self):
+        """
+        the hypothesis as DecodeTree, replayed from the actions on the first access,
+        so only for the hypotheses which need it
+        """
+        if self.__tree is None:
+            actions = []
+            node = self.actions
+            while node is not None:
+                action, node = node
+                actions.append(action)
+
+            tree = DecodeTree(self.grammar.root_node.type)
+            stack = [tree]
+            for t, (rule, token) in enumerate(reversed(actions)):
+                nt = stack.pop()
+                if rule is not None:
+                    nt.t = t
+                    nt.applied_rule = rule
+                    for child_node in rule.children:
+                        nt.add_child(DecodeTree(child_node.type, child_node.label, child_node.value))
+                    stack.extend(child for child in reversed(nt.children) if self.can_expand(child))
+                else:
+                    if nt.value is None:
+                        nt.t = t
+                        nt.value = token
+                    else:
+                        nt.value += token
+                    if self.can_expand(nt):
+                        stack.append(nt)
+
+            self.__tree = tree
+        return self.__tree
+
     def can_expand(self, node):
         if self.grammar.is_value_node(node):
             # if the node is finished
@@ -41,61 +103,72 @@ class Hyp:
 
         return True
 
-    def apply_rule(self, rule, nt=None):
-        if nt is None:
-            nt = self.frontier_nt()
+    def can_expand_id(self, node):
+        """
+        can_expand of a hypothesis node, by its node type id
+        """
+        tables = self.grammar.tables
+        if tables.value_mask[node.type_id]:
+            # if the node is finished
+            return node.value is None or not node.value.endswith('<eos>')
+
+        return not tables.terminal_mask[node.type_id]
+
+    def apply_rule(self, rule_id, hist_row=None):
+        """
+        :param rule_id: id of the applied rule in the grammar
+        :param hist_row: history row of the decoder state of this time step
+        """
+        nt, stack = self.stack
+        rule = self.grammar.rules[rule_id]
+        tables = self.grammar.tables
 
         # assert rule.parent.type == nt.type
-        if rule.parent.type != nt.type:
+        if tables.rule_lhs[rule_id] != nt.type_id:
             self.has_grammar_error = True
 
         self.t += 1
+        self.actions = ((rule, None), self.actions)
+        self.hist = (hist_row, self.hist)
         # set the time step when the rule leading by this nt is applied
-        nt.t = self.t
-        # record the ApplyRule action that is used to expand the current node
-        nt.applied_rule = rule
-
-        for child_node in rule.children:
-            child = DecodeTree(child_node.type, child_node.label, child_node.value)
-
-            nt.add_child(child)
-
-    def append_token(self, token, nt=None):
-        if nt is None:
-            nt = self.frontier_nt()
+        # and record the ApplyRule action that is used to expand the current node
+        node = HypNode(nt.type, nt.label, nt.value, nt.type_id, t=self.t, row=hist_row, rule_id=rule_id,
+                       parent=nt.parent)
+
+        # children are expanded left to right, so they are pushed in reverse
+        child_type_ids = tables.get_rule_children(rule_id).tolist()
+        for child_node, type_id in zip(reversed(rule.children), reversed(child_type_ids)):
+            child = HypNode(child_node.type, child_node.label, child_node.value, type_id, parent=node)
+            if self.can_expand_id(child):
+                stack = (child, stack)
+        self.stack = stack
+
+    def append_token(self, token, hist_row=None):
+        """
+        :param hist_row: history row of the decoder state of this time step
+        """
+        nt, stack = self.stack
 
         self.t += 1
+        self.actions = ((None, token), self.actions)
+        self.hist = (hist_row, self.hist)
 
         if nt.value is None:
             # this terminal node is empty
-            nt.t = self.t
-            nt.value = token
+            node = HypNode(nt.type, nt.label, token, nt.type_id, t=self.t, parent=nt.parent)
         else:
-            nt.value += token
-
-    def frontier_nt_helper(self, node):
-        if node.is_leaf:
-            if self.can_expand(node):
-                return node
-            else:
-                return None
+            node = HypNode(nt.type, nt.label, nt.value + token, nt.type_id, t=nt.t, parent=nt.parent)
 
-        for child in node.children:
-            result = self.frontier_nt_helper(child)
-            if result:
-                return result
-
-        return None
+        # the value node is finished with <eos>
+        if self.can_expand_id(node):
+            stack = (node, stack)
+        self.stack = stack
 
     def frontier_nt(self):
-        if self.__frontier_nt_t == self.t:
-            return self.__frontier_nt
-        else:
-            _frontier_nt = self.frontier_nt_helper(self.tree)
-            self.__frontier_nt = _frontier_nt
-            self.__frontier_nt_t = self.t
+        return self.stack[0] if self.stack else None
 
-            return _frontier_nt
+    def frontier_parent(self):
+        return self.stack[0].parent if self.stack else None
 
     def get_action_parent_t(self):
         """
@@ -103,9 +176,34 @@ class Hyp:
         action was generated
         WARNING: 0 will be returned if parent if None
         """
-        nt = self.frontier_nt()
+        parent = self.frontier_parent()
+
+        if parent:
+            return parent.t
+        else:
+            return 0
+
+    def get_action_parent_row(self):
+        """
+        history row of the decoder state when the parent of the current action was generated,
+        the row of the first time step if parent is None
+        """
+        parent = self.frontier_parent()
 
-        if nt.parent:
-            return nt.parent.t
+        if parent:
+            return parent.row
         else:
-            return 0
\ No newline at end of file
+            return self.get_hist_rows()[0]
+
+    def get_hist_rows(self):
+        """
+        :return: history rows of all the time steps of the hypothesis
+        """
+        rows = []
+        hist = self.hist
+        while hist is not None:
+            row, hist = hist
+            rows.append(row)
+        rows.reverse()
+
+        return rows
@@ -16,19 +16,35 @@ from lang.unaryclosure import compressed_ast_to_normal
 def python_ast_to_parse_tree(node):
     assert isinstance(node, ast.AST)
 
+    tree = ASTNode(type(node))
+    # python ast nodes waiting for conversion, with their parse tree nodes which get the children
+    stack = [(node, tree)]
+    while stack:
+        node, parse_tree = stack.pop()
+        add_parse_tree_children(node, parse_tree, stack)
+
+    return tree
+
+
+def add_parse_tree_children(node, tree, stack):
+    """
+    adds the children of the parse tree of a python ast node to tree, the python ast nodes of its fields
+    are pushed to the stack with their parse tree nodes, which get their children when they are converted
+    """
+    assert isinstance(node, ast.AST)
+
     node_type = type(node)
-    tree = ASTNode(node_type)
 
     # it's a leaf AST node, e.g., ADD, Break, etc.
     if len(node._fields) == 0:
-        return tree
+        return
 
     # if it's a compositional AST node with empty fields
     if is_compositional_leaf(node):
         epsilon = ASTNode('epsilon')
         tree.add_child(epsilon)
 
-        return tree
+        return
 
     fields_info = PY_AST_NODE_FIELDS[node_type.__name__]
 
@@ -47,7 +63,7 @@ def python_ast_to_parse_tree(node):
 
         if isinstance(field_value, ast.AST):
             child = ASTNode(field_type, field_name)
-            child.add_child(python_ast_to_parse_tree(field_value))
+            child.add_child(pending_parse_tree(field_value, stack))
         elif type(field_value) is str \
                 or type(field_value) is bytes \
                 or type(field_value) is int \
@@ -62,13 +78,13 @@ def python_ast_to_parse_tree(node):
             child = ASTNode(list_node_type, field_name)
             for n in field_value:
                 if field_type in {ast.comprehension, ast.excepthandler, ast.arguments, ast.keyword, ast.alias}:
-                    child.add_child(python_ast_to_parse_tree(n))
+                    child.add_child(pending_parse_tree(n, stack))
                 else:
                     intermediate_node = ASTNode(field_type)
                     if field_type is str:
                         intermediate_node.value = n
                     else:
-                        intermediate_node.add_child(python_ast_to_parse_tree(n))
+                        intermediate_node.add_child(pending_parse_tree(n, stack))
                     child.add_child(intermediate_node)
 
         else:
@@ -76,16 +92,43 @@ def python_ast_to_parse_tree(node):
 
         tree.add_child(child)
 
+
+def pending_parse_tree(node, stack):
+    """
+    root of the parse tree of a python ast node, its children are added when the node is popped from the stack
+    """
+    tree = ASTNode(type(node))
+    stack.append((node, tree))
     return tree
 
 
 def parse_tree_to_python_ast(tree):
-    node_type = tree.type
-    node_label = tree.label
+    result = [None]
+    # parse trees waiting for conversion, with the list or python ast node and the index or field name
+    # their python ast goes to
+    stack = [(tree, result, 0)]
+    while stack:
+        tree, target, key = stack.pop()
+        ast_node = python_ast_node(tree, stack)
+        if isinstance(key, int):
+            target[key] = ast_node
+        else:
+            setattr(target, key, ast_node)
+
+    return result[0]
+
 
+def python_ast_node(tree, stack):
+    """
+    python ast node of a parse tree, the parse trees of its children are pushed to the stack for conversion,
+    their fields hold None until they are converted
+    """
     # remove root
-    if node_type == 'root':
-        return parse_tree_to_python_ast(tree.children[0])
+    while tree.type == 'root':
+        tree = tree.children[0]
+
+    node_type = tree.type
+    node_label = tree.label
 
     ast_node = node_type()
     node_type_name = typename(node_type)
@@ -113,15 +156,15 @@ def parse_tree_to_python_ast(tree):
                 if field_type in {ast.comprehension, ast.excepthandler, ast.arguments, ast.keyword, ast.alias}:
                     nodes_in_list = child_node.children
                     for sub_node in nodes_in_list:
-                        sub_node_ast = parse_tree_to_python_ast(sub_node)
-                        field_value.append(sub_node_ast)
+                        stack.append((sub_node, field_value, len(field_value)))
+                        field_value.append(None)
                 else:  # expr stuffs
                     inter_nodes = child_node.children
                     for inter_node in inter_nodes:
                         if inter_node.value is None:
                             assert len(inter_node.children) == 1
-                            sub_node_ast = parse_tree_to_python_ast(inter_node.children[0])
-                            field_value.append(sub_node_ast)
+                            stack.append((inter_node.children[0], field_value, len(field_value)))
+                            field_value.append(None)
                         else:
                             assert len(inter_node.children) == 0
                             field_value.append(inter_node.value)
@@ -129,7 +172,8 @@ def parse_tree_to_python_ast(tree):
                 # this node either holds a value, or is an non-terminal
                 if child_node.value is None:
                     assert len(child_node.children) == 1
-                    field_value = parse_tree_to_python_ast(child_node.children[0])
+                    stack.append((child_node.children[0], ast_node, field_label))
+                    field_value = None
                 else:
                     assert child_node.is_leaf
                     field_value = child_node.value
@@ -288,8 +332,7 @@ def get_grammar(parse_trees):
     for parse_tree in tqdm(parse_trees):
         if parse_tree is None: continue
 
-        parse_tree_rules, rule_parents = parse_tree.get_productions()
-        for rule in parse_tree_rules:
+        for rule, _, _ in parse_tree.iter_productions():
             rules.add(rule)
 
     rules = list(sorted(rules, key=lambda x: x.__repr__()))
@@ -8,28 +8,27 @@ from lang.grammar import type_str_to_type
 
 
 def extract_unary_closure_helper(parse_tree, unary_link, last_node):
-    if parse_tree.is_leaf:
-        if unary_link and unary_link.size > 2:
-            return [unary_link]
-        else:
-            return []
-    elif len(parse_tree.children) > 1:
-        unary_links = []
-        if unary_link and unary_link.size > 2:
-            unary_links.append(unary_link)
-        for child in parse_tree.children:
-            new_node = ASTNode(child.type)
-            child_unary_links = extract_unary_closure_helper(child, new_node, new_node)
-            unary_links.extend(child_unary_links)
-
-        return unary_links
-    else:  # has a single child
-        child = parse_tree.children[0]
-        new_node = ASTNode(child.type, label=child.label)
-        last_node.add_child(new_node)
-        last_node = new_node
+    unary_links = []
+    # (node, unary link it continues, last node of the link) in pre-order
+    stack = [(parse_tree, unary_link, last_node)]
+    while stack:
+        parse_tree, unary_link, last_node = stack.pop()
+        if parse_tree.is_leaf:
+            if unary_link and unary_link.size > 2:
+                unary_links.append(unary_link)
+        elif len(parse_tree.children) > 1:
+            if unary_link and unary_link.size > 2:
+                unary_links.append(unary_link)
+            for child in reversed(parse_tree.children):
+                new_node = ASTNode(child.type)
+                stack.append((child, new_node, new_node))
+        else:  # has a single child
+            child = parse_tree.children[0]
+            new_node = ASTNode(child.type, label=child.label)
+            last_node.add_child(new_node)
+            stack.append((child, unary_link, new_node))
 
-        return extract_unary_closure_helper(child, unary_link, last_node)
+    return unary_links
 
 
 def extract_unary_closure(parse_tree):
@@ -129,6 +128,17 @@ rule_regex = re.compile(r'(?P<parent>.*?) -> \((?P<child>.*?)(\{(?P<clabel>.*?)\
 
 
 def compressed_ast_to_normal(parse_tree):
+    # nodes waiting for decompression, the replaced nodes are decompressed before their children
+    stack = [parse_tree]
+    while stack:
+        decompress_node(stack.pop(), stack)
+
+
+def decompress_node(parse_tree, stack):
+    """
+    replaces a node compressed by unary closures with its chain of nodes, and pushes the children
+    of the node for decompression to the stack
+    """
     if parse_tree.label and '@' in parse_tree.label and '$' in parse_tree.label:
         label = parse_tree.label
         label = label.replace('$', ' ')
@@ -157,52 +167,36 @@ def compressed_ast_to_normal(parse_tree):
         last_node.value = parse_tree.value
         for child in parse_tree.children:
             last_node.add_child(child)
-            compressed_ast_to_normal(child)
-
+        stack.extend(reversed(parse_tree.children))
 
         parent_node = parse_tree.parent
         assert len(parent_node.children) == 1
-        del parent_node.children[0]
+        parent_node.remove_child(parent_node.children[0])
         parent_node.add_child(first_node)
-        # return first_node
     else:
-        new_child_trees = []
-        for child in parse_tree.children[:]:
-            compressed_ast_to_normal(child)
-        #     new_child_trees.append(new_child_tree)
-        # del parse_tree.children[:]
-        # for child_tree in new_child_trees:
-        #     parse_tree.add_child(child_tree)
-        #
-        # return parse_tree
+        stack.extend(reversed(parse_tree.children))
 
 
 def match_sub_tree(parse_tree, cur_match_node, is_root=False):
-    cur_level_match = False
-    if parse_tree.type == cur_match_node.type and (len(parse_tree.children) == 1 or cur_match_node.is_leaf) and \
+    while parse_tree.type == cur_match_node.type and (len(parse_tree.children) == 1 or cur_match_node.is_leaf) and \
             (is_root or parse_tree.label == cur_match_node.label):
-        cur_level_match = True
-
-    if cur_level_match:
         if cur_match_node.is_leaf:
             return parse_tree
 
-        last_node = match_sub_tree(parse_tree.children[0], cur_match_node.children[0])
-        return last_node
-    else:
-        return None
+        parse_tree = parse_tree.children[0]
+        cur_match_node = cur_match_node.children[0]
+        is_root = False
+
+    return None
 
 
 def find(parse_tree, sub_tree):
     match_results = []
-    last_node = match_sub_tree(parse_tree, sub_tree, True)
-
-    if last_node:
-        match_results.append((parse_tree, last_node))
+    for node in parse_tree.nodes:
+        last_node = match_sub_tree(node, sub_tree, True)
 
-    for child in parse_tree.children:
-        child_match_results = find(child, sub_tree)
-        match_results.extend(child_match_results)
+        if last_node:
+            match_results.append((node, last_node))
 
     return match_results
 
@@ -218,7 +212,7 @@ def apply_unary_closure(parse_tree, unary_closure, unary_link):
             leaf.add_child(child)
 
         new_node = closure_copy.children[0]
-        first_node.children.remove(first_node.children[0])
+        first_node.remove_child(first_node.children[0])
         first_node.add_child(new_node)
 
 
@@ -60,6 +60,10 @@ if __name__ == '__main__':
         logging.info('Loading model: {}'.format(args.model))
         # device map location allows to load model trained on GPU on CPU env and vice versa
         model = torch.load(args.model, device_map_location(args.cuda))
+        # models saved before an option was introduced take its current value
+        for key, value in vars(args).items():
+            if not hasattr(model.config, key):
+                setattr(model.config, key, value)
     else:
         logging.info('Creating new model'.format(args.model))
         emb_file = os.path.join(args.data_dir, 'word_embeddings.pth')
@@ -0,0 +1,57 @@
+from collections import OrderedDict
+
+
+class EncoderCache(object):
+    """
+    LRU cache of the encoder outputs of single examples, the entries are tuples of tensors.
+    The least recently used entries are dropped when the tensors take more than max_bytes.
+    """
+    def __init__(self, max_bytes=0):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        """
+        :return: the cached tensors or None, counted as a hit or a miss
+        """
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        size = entry_bytes(value)
+        if size > self.max_bytes:
+            return
+        if key in self.entries:
+            self.bytes -= entry_bytes(self.entries.pop(key))
+        self.entries[key] = value
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            _, dropped = self.entries.popitem(last=False)
+            self.bytes -= entry_bytes(dropped)
+
+    def clear(self):
+        self.entries.clear()
+        self.bytes = 0
+
+
+def entry_bytes(tensors):
+    return sum([t.numel() * t.element_size() for t in tensors])
+
+
+def tree_key(tree):
+    """
+    hashable structure of a parsed tree: token index, parent and children of every node
+    """
+    arrays = tree.arrays()
+    return arrays.idx.tobytes(), arrays.parents.tobytes(), arrays.children.tobytes()
@@ -21,38 +21,17 @@ class CondAttLSTM(nn.Module):
         self.context_dim = context_dim
         self.input_dim = input_dim
 
-        # one W for all x
-        self.W_ix = nn.Linear(input_dim, output_dim)
-        init.xavier_uniform(self.W_ix.weight)
-        self.W_ix.bias = nn.Parameter(torch.FloatTensor(output_dim).zero_())
-
-        # input gate
-        self.W_i = nn.Linear(output_dim + context_dim + output_dim + output_dim, output_dim, bias=False)
-        init.orthogonal(self.W_i.weight)
-
+        # input, forget, memory cell and output gates in one projection each,
+        # gates are stacked in i, f, c, o order
+        self.W_x = nn.Linear(input_dim, 4 * output_dim)
+        self.W_h = nn.Linear(output_dim + context_dim + output_dim + output_dim, 4 * output_dim, bias=False)
+        for k in range(4):
+            gate = slice(k * output_dim, (k + 1) * output_dim)
+            init.xavier_uniform(self.W_x.weight.data[gate])
+            init.orthogonal(self.W_h.weight.data[gate])
+        self.W_x.bias = nn.Parameter(torch.FloatTensor(4 * output_dim).zero_())
         # forget gate
-        self.W_fx = nn.Linear(input_dim, output_dim)
-        init.xavier_uniform(self.W_fx.weight)
-        self.W_fx.bias = nn.Parameter(torch.FloatTensor(output_dim).fill_(1.0))
-
-        self.W_f = nn.Linear(output_dim + context_dim + output_dim + output_dim, output_dim, bias=False)
-        init.orthogonal(self.W_f.weight)
-
-        # memory cell new value
-        self.W_cx = nn.Linear(input_dim, output_dim)
-        init.xavier_uniform(self.W_cx.weight)
-        self.W_cx.bias = nn.Parameter(torch.FloatTensor(output_dim).zero_())
-
-        self.W_c = nn.Linear(output_dim + context_dim + output_dim + output_dim, output_dim, bias=False)
-        init.orthogonal(self.W_c.weight)
-
-        # output gate
-        self.W_ox = nn.Linear(input_dim, output_dim)
-        init.xavier_uniform(self.W_ox.weight)
-        self.W_ox.bias = nn.Parameter(torch.FloatTensor(output_dim).zero_())
-
-        self.W_o = nn.Linear(output_dim + context_dim + output_dim + output_dim, output_dim, bias=False)
-        init.orthogonal(self.W_o.weight)
+        self.W_x.bias.data[output_dim:2 * output_dim] = 1.0
 
         # attention layer
         self.att_ctx = nn.Linear(context_dim, att_hidden_dim)
@@ -80,47 +59,84 @@ class CondAttLSTM(nn.Module):
         self.dropout = config.decoder_dropout
         self.config = config
 
-    def before_eval(self):
-        self.W_ifco_x = nn.Linear(self.input_dim, 4*self.output_dim)
-        self.W_ifco_x.weight = nn.Parameter(torch.cat([
-            self.W_ix.weight.clone(),
-            self.W_fx.weight.clone(),
-            self.W_cx.weight.clone(),
-            self.W_ox.weight.clone()
-        ], dim=0).data)
-        self.W_ifco_x.bias = nn.Parameter(torch.cat([
-            self.W_ix.bias.clone(),
-            self.W_fx.bias.clone(),
-            self.W_cx.bias.clone(),
-            self.W_ox.bias.clone()
-        ]).data)
-
-    def after_eval(self):
-        del self.W_ifco_x
+    def __setstate__(self, state):
+        super(CondAttLSTM, self).__setstate__(state)
+        if 'W_x' not in self._modules:
+            self.fuse_gates()
+
+    def fuse_gates(self):
+        """
+        converts separate gate layers of models saved before the gates were fused
+        """
+        W_x = nn.Linear(self.input_dim, 4 * self.output_dim)
+        W_x.weight = nn.Parameter(torch.cat([self.W_ix.weight.data,
+                                             self.W_fx.weight.data,
+                                             self.W_cx.weight.data,
+                                             self.W_ox.weight.data], dim=0))
+        W_x.bias = nn.Parameter(torch.cat([self.W_ix.bias.data,
+                                           self.W_fx.bias.data,
+                                           self.W_cx.bias.data,
+                                           self.W_ox.bias.data], dim=0))
+        W_h = nn.Linear(self.W_i.weight.data.shape[1], 4 * self.output_dim, bias=False)
+        W_h.weight = nn.Parameter(torch.cat([self.W_i.weight.data,
+                                             self.W_f.weight.data,
+                                             self.W_c.weight.data,
+                                             self.W_o.weight.data], dim=0))
+
+        for name in ['W_ix', 'W_fx', 'W_cx', 'W_ox', 'W_i', 'W_f', 'W_c', 'W_o']:
+            del self._modules[name]
+        self.W_x = W_x
+        self.W_h = W_h
+
+    def gate_linear(self, x, dr, layer, width):
+        """
+        applies fused gates layer to the input with a different dropout mask for every gate
+        :param x: (batch_size, ..., width)
+        :param dr: (4, batch_size, ..., width)
+        :return: (batch_size, ..., 4*output_dim)
+        """
+        shape = list(x.size())
+        # (4, N, width)
+        x_dr = (x.unsqueeze(0) * dr).view(4, -1, width)
+        # (4, width, output_dim)
+        weight = layer.weight[:, :width].contiguous().view(4, self.output_dim, width).transpose(1, 2)
+        # (N, 4*output_dim)
+        gates = torch.bmm(x_dr, weight).permute(1, 0, 2).contiguous().view(-1, 4 * self.output_dim)
+        if layer.bias is not None:
+            gates = gates + layer.bias
+        return gates.view(*(shape[:-1] + [4 * self.output_dim]))
+
+    def project_context(self, context):
+        """
+        attention projection of the encoder context, it does not change across decoding steps
+        :param context: (batch_size, context_size, context_dim)
+        :return: (batch_size, context_size, att_layer1_dim)
+        """
+        return self.att_ctx(context)
 
     # one time step at the time
-    def forward(self, t, x, context, hist_h, h, c, parent_h):
+    def forward(self, t, x, context, context_att_trans, hist_h, h, c, parent_h, context_mask=None):
         # dropout normalization
         x *= 1.0-self.dropout
         dr_H = dropout_matrix(4, p=self.dropout, train=False, cuda=h.is_cuda)
         # (batch_size, 4*output_dim)
-        #x_ifoc = self.W_ifco_x(x)
-        xi, xf, xo, xc = self.W_ix(x), self.W_fx(x), self.W_ox(x), self.W_cx(x) #torch.split(x_ifoc, self.output_dim, dim=-1)
+        x_ifco = self.W_x(x)
 
         return self.forward_node(t,
-                                 xi, xf, xo, xc,
-                                 context, hist_h,
+                                 x_ifco,
+                                 context, context_att_trans, hist_h,
                                  h, c, parent_h,
-                                 dr_H)
+                                 dr_H, context_mask)
 
     def forward_node(self, t,
-                     xi, xf, xo, xc,
-                     context, hist_h,
+                     x_ifco,
+                     context, context_att_trans, hist_h,
                      h, c, par_h,
-                     dr_H):
-        # (batch_size, context_size, att_layer1_dim)
-        context_att_trans = self.att_ctx(context)
-
+                     dr_H, context_mask=None):
+        """
+        :param context_mask: (batch_size, context_size), padded context positions
+                             which get no attention, None when nothing is padded
+        """
         # (batch_size, att_layer1_dim)
         h_att_trans = self.att_h(h)
 
@@ -129,6 +145,8 @@ class CondAttLSTM(nn.Module):
 
         # (batch_size, context_size)
         att_raw = self.att(att_hidden).squeeze(2)
+        if context_mask is not None:
+            att_raw = att_raw.masked_fill(context_mask, -float('inf'))
 
         # (batch_size, context_size)
         ctx_att = self.softmax(att_raw)
@@ -168,17 +186,24 @@ class CondAttLSTM(nn.Module):
         if not self.config.parent_hidden_state_feed:
             par_h *= 0.
 
-        # (batch_size, output_dim + context_dim + output_dim + output_dim)
-        h_comb_i = torch.cat([h*dr_H[0], ctx_vec, par_h, h_ctx_vec], dim=-1)
-        h_comb_f = torch.cat([h*dr_H[1], ctx_vec, par_h, h_ctx_vec], dim=-1)
-        h_comb_c = torch.cat([h*dr_H[2], ctx_vec, par_h, h_ctx_vec], dim=-1)
-        h_comb_o = torch.cat([h*dr_H[3], ctx_vec, par_h, h_ctx_vec], dim=-1)
+        if dr_H.dim() == 1:
+            # the same scaling for all gates, one projection of the whole recurrent input
+            # (batch_size, output_dim + context_dim + output_dim + output_dim)
+            h_comb = torch.cat([h*dr_H[0], ctx_vec, par_h, h_ctx_vec], dim=-1)
+            # (batch_size, 4*output_dim)
+            h_ifco = self.W_h(h_comb)
+        else:
+            # per gate dropout masks of h, a batched product over the four gates
+            h_rest = torch.cat([ctx_vec, par_h, h_ctx_vec], dim=-1)
+            h_ifco = self.gate_linear(h, dr_H, self.W_h, self.output_dim) + \
+                     F.linear(h_rest, self.W_h.weight[:, self.output_dim:])
 
         # (batch_size, output_dim)
-        i = F.sigmoid(xi + self.W_i(h_comb_i))
-        f = F.sigmoid(xf + self.W_f(h_comb_f))
-        c = f * c + i * F.tanh(xc + self.W_c(h_comb_c))
-        o = F.sigmoid(xo + self.W_o(h_comb_o))
+        gi, gf, gc, go = torch.split(x_ifco + h_ifco, self.output_dim, dim=-1)
+        i = F.sigmoid(gi)
+        f = F.sigmoid(gf)
+        c = f * c + i * F.tanh(gc)
+        o = F.sigmoid(go)
 
         h = o * F.tanh(c)
 
@@ -191,45 +216,88 @@ class CondAttLSTM(nn.Module):
         dr_X = dropout_matrix(4, X.shape[0], 1, X.shape[2], p=self.dropout, cuda=h.is_cuda)
         dr_H = dropout_matrix(4, X.shape[0], self.output_dim, p=self.dropout, cuda=h.is_cuda)
         # calculate all X dense transformation at once
-        # (batch_size, max_sequence_length, output_dim)
-        Xi, Xf, Xo, Xc = self.W_ix(X*dr_X[0]), self.W_fx(X*dr_X[1]), self.W_ox(X*dr_X[2]), self.W_cx(X*dr_X[3])
-        # (batch_size, max_sequence_length, decoder_hidden_dim)
-        output_h = None
+        # (batch_size, max_sequence_length, 4*output_dim)
+        X_ifco = self.gate_linear(X, dr_X, self.W_x, self.input_dim)
+        # (batch_size, context_size, att_layer1_dim)
+        context_att_trans = self.project_context(context)
+        batch_size = X.shape[0]
+        # (max_sequence_length * batch_size, decoder_hidden_dim)
+        history = HistoryBuffer(length, batch_size, self.output_dim, cuda=h.is_cuda)
+        # (batch_size)
+        slots = arange_var(batch_size, cuda=h.is_cuda)
         # (batch_size, max_sequence_length, encoder_hidden_dim)
         output_ctx = []
 
         for t in range(length):
             # extract parent node from history
             if t and self.parent_hidden_state_feed:
-                # gather require index to have the same size as input
-                # except the gathering dimension
-                # (batch_size, 1, hidden_dim)
-                index = Var(parent_t[:, t][:, None, None].
-                            expand(-1, -1, self.output_dim), requires_grad=False)
                 # (batch_size, hidden_dim)
-                par_h = torch.gather(output_h, 1, index).squeeze(1)
+                par_h = history.gather(history.row(Var(parent_t[:, t], requires_grad=False), slots))
             else:
                 par_h = Var(zeros_like(h, h.is_cuda))
 
-            xi, xf, xo, xc = Xi[:, t, :].squeeze(1), \
-                             Xf[:, t, :].squeeze(1), \
-                             Xo[:, t, :].squeeze(1), \
-                             Xc[:, t, :].squeeze(1)
+            # (batch_size, t, hidden_dim)
+            if t and self.config.tree_attention:
+                hist_h = history.gather(history.row(arange_var(t, cuda=h.is_cuda)[None], slots[:, None]))
+            else:
+                hist_h = None
+
+            x_ifco = X_ifco[:, t, :]
 
             h, c, ctx_vec = self.forward_node(t,
-                                              xi, xf, xo, xc,
-                                              context, output_h,
+                                              x_ifco,
+                                              context, context_att_trans, hist_h,
                                               h, c, par_h,
                                               dr_H)
-            if output_h is None:
-                output_h = h[:, None]
-            else:
-                output_h = torch.cat([output_h, h[:, None]], dim=1)
+            history.write(t, h)
             output_ctx.append(ctx_vec[:, None])
 
+        # (batch_size, max_sequence_length, decoder_hidden_dim)
+        output_h = history.steps(length)
         return output_h, torch.cat(output_ctx, dim=1)
 
 
+class HistoryBuffer(object):
+    """
+    preallocated history of decoder hidden states, written in place step by step:
+    the state of slot k (batch example or beam hypothesis) at time step t is stored in row t * width + k
+    """
+    def __init__(self, max_time_step, width, hidden_dim, cuda=False):
+        self.width = width
+        self.hidden_dim = hidden_dim
+        # (max_time_step * width, hidden_dim)
+        self.data = zeros_var(max_time_step * width, hidden_dim, cuda=cuda)
+
+    def row(self, t, slot):
+        """
+        works for ints as well as for index tensors
+        """
+        return t * self.width + slot
+
+    def write(self, t, h):
+        """
+        :param h: (n <= width, hidden_dim), states of the first n slots at time step t
+        """
+        start = self.row(t, 0)
+        self.data[start:start + h.size()[0]] = h
+
+    def gather(self, rows):
+        """
+        reads rows with index_select, which does not keep the buffer for backward,
+        so the buffer can still be written after the read
+        :param rows: LongTensor of any shape
+        :return: (*rows.shape, hidden_dim)
+        """
+        states = self.data.index_select(0, rows.view(-1))
+        return states.view(*(list(rows.size()) + [self.hidden_dim]))
+
+    def steps(self, length):
+        """
+        :return: (width, length, hidden_dim), all the states of the first length time steps
+        """
+        return self.data[:length * self.width].view(length, self.width, self.hidden_dim).transpose(0, 1)
+
+
 class PointerNet(nn.Module):
     def __init__(self, config):
         super(PointerNet, self).__init__()
@@ -249,9 +317,18 @@ class PointerNet(nn.Module):
         self.log_softmax = nn.LogSoftmax(dim=-1)
         self.softmax = nn.Softmax(dim=-1);
 
-    def forward_scores(self, ctx, decoder_states):
+    def project_context(self, ctx):
+        """
+        input projection of the encoder context, it does not change across decoding steps
+        :param ctx: (batch_size, query_length, encoder_hidden_dim)
+        :return: (batch_size, query_length, ptrnet_hidden_dim)
+        """
+        return self.dense1_input(ctx)
+
+    def forward_scores(self, ctx, decoder_states, ctx_trans=None):
         # (batch_size, query_length, ptrnet_hidden_dim)
-        ctx_trans = self.dense1_input(ctx)
+        if ctx_trans is None:
+            ctx_trans = self.project_context(ctx)
 
         # (batch_size, max_decode_step, ptrnet_hidden_dim)
         decoder_trans = self.dense1_h(decoder_states)
@@ -271,9 +348,12 @@ class PointerNet(nn.Module):
         # (batch_size,  max_decode_step, query_length)
         return scores.squeeze(3)
 
-    def forward(self, ctx, decoder_states):
+    def forward(self, ctx, decoder_states, ctx_trans=None, ctx_mask=None):
         # (batch_size,  max_decode_step, query_length)
-        scores = self.forward_scores(ctx, decoder_states)
+        scores = self.forward_scores(ctx, decoder_states, ctx_trans)
+        if ctx_mask is not None:
+            # padded positions can not be copied
+            scores = scores.masked_fill(ctx_mask.unsqueeze(1), -float('inf'))
 
         # (batch_size,  max_decode_step, query_length)
         scores = self.softmax(scores)
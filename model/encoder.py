@@ -1,3 +1,4 @@
+import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -157,26 +158,34 @@ class ChildSumTreeLSTM(nn.Module):
         h = torch.mul(o, F.tanh(c))
         return c, h
 
-    def forward_inner(self, tree, Xi, Xf, Xu, Xo, dr_H):
-        _ = [self.forward_inner(tree.children[idx], Xi, Xf, Xu, Xo, dr_H) for idx in range(tree.num_children)]
+    def forward_inner(self, tree, Xi, Xf, Xu, Xo, dr_H, states):
+        # nodes in post-order, children from left to right before their parent
+        post_order = []
+        stack = [tree]
+        while stack:
+            node = stack.pop()
+            post_order.append(node)
+            stack.extend(node.children)
+        post_order.reverse()
+
+        for node in post_order:
+            if node.num_children == 0:
+                # (1, mem_dim)
+                child_c = init_var(1, self.mem_dim, cuda=Xi.is_cuda, scale=0.1, training=self.training)
+                child_h = init_var(1, self.mem_dim, cuda=Xi.is_cuda, scale=0.1, training=self.training)
+            else:
+                # (k_children, mem_dim)
+                child_c, child_h = zip(*map(lambda x: states[x.idx], node.children))
+                child_c, child_h = torch.cat(child_c, dim=0), torch.cat(child_h, dim=0)
 
-        if tree.num_children == 0:
             # (1, mem_dim)
-            child_c = init_var(1, self.mem_dim, cuda=Xi.is_cuda, scale=0.1, training=self.training)
-            child_h = init_var(1, self.mem_dim, cuda=Xi.is_cuda, scale=0.1, training=self.training)
-        else:
-            # (k_children, mem_dim)
-            child_c, child_h = zip(*map(lambda x: x.state, tree.children))
-            child_c, child_h = torch.cat(child_c, dim=0), torch.cat(child_h, dim=0)
-
-        # (1, mem_dim)
-        xi, xf, xo, xu = Xi[tree.idx, :], \
-                         Xf[tree.idx, :], \
-                         Xo[tree.idx, :], \
-                         Xu[tree.idx, :]
+            xi, xf, xo, xu = Xi[node.idx, :], \
+                             Xf[node.idx, :], \
+                             Xo[node.idx, :], \
+                             Xu[node.idx, :]
 
-        tree.state = self.node_forward(xi, xf, xo, xu, child_c, child_h, dr_H)
-        return tree.state
+            states[node.idx] = self.node_forward(xi, xf, xo, xu, child_c, child_h, dr_H)
+        return states[tree.idx]
 
     def forward(self, tree, X):
         dr_X = dropout_matrix(4, 1, self.in_dim, train=self.training, cuda=X.is_cuda, p=self.dropout)
@@ -187,10 +196,154 @@ class ChildSumTreeLSTM(nn.Module):
         Xu = self.ux(X * dr_X[2])
         Xo = self.ox(X * dr_X[3])
 
-        self.forward_inner(tree, Xi, Xf, Xu, Xo, dr_H)
-        return tree.state[1], \
-               tree.state[0], \
-               torch.stack([t.state[1] for t in tree.data()]).squeeze(1)
+        # (c, h) of every node indexed by tree.idx, trees themselves are never modified
+        states = [None] * len(X)
+        root_c, root_h = self.forward_inner(tree, Xi, Xf, Xu, Xo, dr_H, states)
+        return root_h, \
+               root_c, \
+               torch.stack([states[t.idx][1] for t in tree.data()]).squeeze(1)
+
+    def forward_levels(self, trees, X):
+        """
+        evaluates all the trees of the batch at once: every node of the same height
+        is computed by one batched gate computation, children states are summed with index_add
+        :param trees: list of batch_size trees
+        :param X: (batch_size, query_length, in_dim)
+        :return: (batch_size, mem_dim), (batch_size, mem_dim), (batch_size, max_tree_size, mem_dim)
+        """
+        batch_size, length = X.size()[0], X.size()[1]
+        cuda = X.is_cuda
+        schedule = LevelSchedule(trees, length, cuda)
+
+        # dropout masks are drawn per tree, the same way as in recursive mode
+        # (4, batch_size, 1, in_dim)
+        dr_X = dropout_matrix(4, batch_size, 1, self.in_dim, train=self.training, cuda=cuda, p=self.dropout)
+        # (4, batch_size, mem_dim)
+        dr_H = dropout_matrix(4, batch_size, self.mem_dim, train=self.training, cuda=cuda, p=self.dropout)
+
+        # (batch_size * query_length, mem_dim)
+        Xi = self.ix(X * dr_X[0]).view(-1, self.mem_dim)
+        Xf = self.fx(X * dr_X[1]).view(-1, self.mem_dim)
+        Xu = self.ux(X * dr_X[2]).view(-1, self.mem_dim)
+        Xo = self.ox(X * dr_X[3]).view(-1, self.mem_dim)
+
+        # states of all nodes in the schedule order, every level writes its own slice.
+        # the last row is a zero state used as padding of the shorter trees
+        h_states = zeros_var(schedule.total_size + 1, self.mem_dim, cuda=cuda)
+        c_states = zeros_var(schedule.total_size + 1, self.mem_dim, cuda=cuda)
+        start = 0
+        for rows, tree_ids, children, child_parents in schedule.levels:
+            level_size = rows.size()[0]
+            # (level_size, mem_dim)
+            xi, xf, xo, xu = Xi.index_select(0, rows), \
+                             Xf.index_select(0, rows), \
+                             Xo.index_select(0, rows), \
+                             Xu.index_select(0, rows)
+            # (4, level_size, mem_dim)
+            dr = dr_H.index_select(1, tree_ids)
+
+            if children is None:
+                # leaves have one initial child state each
+                # (level_size, mem_dim)
+                child_c = init_var(level_size, self.mem_dim, cuda=cuda, scale=0.1, training=self.training)
+                child_h = init_var(level_size, self.mem_dim, cuda=cuda, scale=0.1, training=self.training)
+                child_h_sum = child_h
+            else:
+                # (children_num, mem_dim)
+                child_c = c_states.index_select(0, children)
+                child_h = h_states.index_select(0, children)
+                xf = xf.index_select(0, child_parents)
+                # (level_size, mem_dim)
+                child_h_sum = zeros_var(level_size, self.mem_dim, cuda=cuda).index_add(0, child_parents, child_h)
+
+            i = F.sigmoid(xi + self.ih(child_h_sum * dr[0]))
+            o = F.sigmoid(xo + self.oh(child_h_sum * dr[1]))
+            u = F.tanh(xu + self.uh(child_h_sum * dr[2]))
+
+            if children is None:
+                f = F.sigmoid(self.fh(child_h * dr[3]) + xf + self.fb)
+                fc = f * child_c
+            else:
+                f = F.sigmoid(self.fh(child_h * dr[3].index_select(0, child_parents)) + xf + self.fb)
+                fc = zeros_var(level_size, self.mem_dim, cuda=cuda).index_add(0, child_parents, f * child_c)
+
+            c = u * i + fc
+            h = torch.mul(o, F.tanh(c))
+
+            h_states[start:start + level_size] = h
+            c_states[start:start + level_size] = c
+            start += level_size
+
+        ctx = h_states.index_select(0, schedule.ctx).view(batch_size, schedule.max_size, self.mem_dim)
+
+        return h_states.index_select(0, schedule.roots), \
+               c_states.index_select(0, schedule.roots), \
+               ctx
+
+
+class LevelSchedule(object):
+    """
+    topological level schedule of a batch of trees: nodes are grouped by their height,
+    so that every node is computed after all of its children
+    """
+    def __init__(self, trees, length, cuda=False):
+        arrays = [tree.arrays() for tree in trees]
+        sizes = np.array([a.size for a in arrays], dtype=np.int64)
+        # offset of every tree in the batch-wide node numbering
+        offsets = np.zeros(len(arrays), dtype=np.int64)
+        offsets[1:] = np.cumsum(sizes)[:-1]
+
+        # (total_nodes)
+        tree_ids = np.repeat(np.arange(len(arrays)), sizes)
+        heights = np.concatenate([a.heights for a in arrays])
+        rows = tree_ids * length + np.concatenate([a.idx for a in arrays])
+        parents = np.concatenate([np.where(a.parents >= 0, a.parents + offset, -1)
+                                  for a, offset in zip(arrays, offsets)])
+
+        # nodes in the order they are computed, and position of every node in that order
+        order = np.argsort(heights, kind='stable')
+        state_idx = np.empty_like(order)
+        state_idx[order] = np.arange(len(order))
+        level_offsets = np.searchsorted(heights[order], np.arange(heights.max() + 2))
+
+        # non-root nodes grouped by the height of their parent, in node order inside every group
+        child_nodes = np.nonzero(parents >= 0)[0]
+        parent_heights = heights[parents[child_nodes]]
+        child_order = np.argsort(parent_heights, kind='stable')
+        child_nodes = child_nodes[child_order]
+        child_offsets = np.searchsorted(parent_heights[child_order], np.arange(heights.max() + 2))
+
+        self.levels = []
+        for height in range(heights.max() + 1):
+            level = order[level_offsets[height]:level_offsets[height + 1]]
+            if height == 0:
+                children, child_parents = None, None
+            else:
+                # children of the level nodes, and positions of their parents inside the level
+                children = child_nodes[child_offsets[height]:child_offsets[height + 1]]
+                child_parents = state_idx[parents[children]] - level_offsets[height]
+                children = self.index(state_idx[children], cuda)
+                child_parents = self.index(child_parents, cuda)
+            self.levels.append((self.index(rows[level], cuda), self.index(tree_ids[level], cuda),
+                                children, child_parents))
+
+        self.roots = self.index(state_idx[offsets + np.array([a.root for a in arrays])], cuda)
+
+        # encoder context follows the order of tree.data(), padded with the zero state
+        self.max_size = int(sizes.max())
+        self.total_size = len(order)
+        pad = self.total_size
+        ctx = np.full((len(arrays), self.max_size), pad, dtype=np.int64)
+        for b, (a, offset) in enumerate(zip(arrays, offsets)):
+            ctx[b, :a.size] = state_idx[offset:offset + a.size]
+        self.ctx = self.index(ctx.reshape(-1), cuda)
+
+    @staticmethod
+    def index(array, cuda):
+        tensor = torch.from_numpy(np.ascontiguousarray(array, dtype=np.int64))
+        if cuda:
+            tensor = tensor.cuda()
+        return Var(tensor, requires_grad=False)
 
 
 class EncoderLSTMWrapper(nn.Module):
@@ -237,6 +390,8 @@ class EncoderLSTMWrapper(nn.Module):
 
     def forward(self, trees, inputs):
         if self.config.encoder == 'recursive-lstm':
+            if self.config.level_batching:
+                return self.encoder.forward_levels(trees, inputs)
             return self.forward_recursive(trees, inputs)
         elif self.config.encoder == 'bi-lstm':
             return self.forward_lstm(inputs)
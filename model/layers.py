@@ -1,3 +1,4 @@
+import torch
 import torch.nn as nn
 import torch.nn.init as init
 
@@ -16,3 +17,20 @@ class LogSoftmaxDense(nn.Linear):
     def forward_train(self, input):
         o = super().forward(input)
         return self.log_softmax(o)
+
+    def forward_subset(self, input, indices, mask):
+        """
+        softmax over a different subset of the outputs for every row, only the subset is computed
+        :param input: (batch_size, in_features)
+        :param indices: (batch_size, subset_size), output ids of the subsets
+        :param mask: (batch_size, subset_size), padding positions of the shorter subsets
+        :return: (batch_size, subset_size)
+        """
+        batch_size, subset_size = indices.size()
+        # (batch_size, subset_size, in_features)
+        weight = self.weight.index_select(0, indices.view(-1)).view(batch_size, subset_size, -1)
+        # (batch_size, subset_size)
+        bias = self.bias.index_select(0, indices.view(-1)).view(batch_size, subset_size)
+        o = torch.bmm(weight, input.unsqueeze(2)).squeeze(2) + bias
+        o = o.masked_fill(mask, -float('inf'))
+        return self.softmax(o)
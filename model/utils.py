@@ -34,6 +34,13 @@ def from_long_list(ls, cuda):
     return tensor
 
 
+def arange_var(n, cuda=False):
+    t = torch.arange(0, n).long()
+    if cuda:
+        t = t.cuda()
+    return Var(t, requires_grad=False)
+
+
 def zeros(*shape, cuda=False):
     t = torch.FloatTensor(*shape).zero_()
     if cuda:
@@ -139,5 +146,26 @@ def reverse(tensor, dim=0):
     return torch.index_select(tensor, dim, idx)
 
 
+def sample_ids(prob, top_k=0, top_p=1.0):
+    """
+    samples an id from every row, restricted to the top_k most probable ids (all of them with 0)
+    and to the smallest set of the most probable ids with a total probability of at least top_p
+    :param prob: (batch_size, n), probabilities, the rows do not need to be normalized
+    :return: (batch_size)
+    """
+    if top_k <= 0 and top_p >= 1.0:
+        return torch.multinomial(prob, 1).squeeze(1)
+
+    if top_k > 0:
+        # (batch_size, top_k), sorted in descending order
+        prob, ids = prob.topk(min(top_k, prob.size()[1]), dim=1)
+    else:
+        prob, ids = prob.sort(dim=1, descending=True)
 
+    if top_p < 1.0:
+        # ids whose more probable ids already reach top_p of the total probability are dropped,
+        # the most probable id is always kept
+        mass_before = prob.cumsum(dim=1) - prob
+        prob = prob.masked_fill(mass_before >= top_p * prob.sum(dim=1, keepdim=True), 0.)
 
+    return ids.gather(1, torch.multinomial(prob, 1)).squeeze(1)
@@ -1,4 +1,5 @@
-import sys
+import time
+from collections import Counter
 from torch.nn import Parameter
 import numpy as np
 
@@ -7,9 +8,12 @@ from model.encoder import EncoderLSTMWrapper
 from model.decoder import *
 from model.layers import *
 from model.utils import *
+from model.cache import EncoderCache, tree_key
 from lang.hyp import Hyp
 
-sys.setrecursionlimit(50000)
+# largest score one step can add to a hypothesis: log(prob + 1.e-7) is computed in float32, where 1 + 1.e-7
+# rounds up to 1 + 1.19e-7, with a margin for probabilities which round a few ulps above 1
+MAX_STEP_SCORE = float(torch.log(torch.ones(1) + 1.e-7)) + 1.e-6
 
 
 class Tree2TreeModel(nn.Module):
@@ -68,273 +72,585 @@ class Tree2TreeModel(nn.Module):
         self.log_softmax = nn.LogSoftmax(dim=-1)
         self.softmax = nn.Softmax(dim=-1)
 
-    def forward(self, tree, query_tokens, query_raw):
-        vocab_embedding = self.vocab_gen_softmax.weight
-        rule_embedding = self.rule_gen_softmax.weight
-
-        # forward encoding accepts batches, whether forward of all model takes one example at time
-        h, c, ctx = self.forward_encode([tree], query_tokens[None])
-        # (decoder_hidden_dim)
-        h = h.squeeze(0)
-        c = c.squeeze(0)
-        h = h if self.thought else init_var(self.config.decoder_hidden_dim,
-                                            cuda=h.is_cuda, scale=0.1, training=self.training)
-        c = c if self.thought else init_var(self.config.decoder_hidden_dim,
-                                            cuda=c.is_cuda, scale=0.1, training=self.training)
+        # decoding counters: decoder steps of the examples, examples stopped by beam_stop and by the time budget
+        self.decode_counters = Counter()
+        # encodings of the examples decoded before, valid while the model stays in evaluation mode
+        self.encoder_cache = EncoderCache()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # cached encodings are not saved with the model
+        state['encoder_cache'] = None
+        return state
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        # models saved before the decoding counters were introduced
+        if 'decode_counters' not in state:
+            self.decode_counters = Counter()
+        self.encoder_cache = EncoderCache()
+
+    def train(self, mode=True):
+        # the parameters change in training, so the cached encodings are dropped
+        if mode:
+            self.encoder_cache.clear()
+        return super().train(mode)
 
-        completed_hyps = []
-        completed_hyp_num = 0
-        live_hyp_num = 1
+    def forward(self, tree, query_tokens, query_raw):
+        return self.decode_batch([tree], query_tokens[None], [query_raw])[0]
+
+    def decode_batch(self, trees, queries, query_raws):
+        """
+        decodes a batch of examples with the decode_mode of the config
+        :param trees: list of query trees
+        :param queries: (batch_size, query_length), padded query token ids
+        :param query_raws: list of query token lists
+        :return: list of completed hypotheses sorted by score, one list for every example
+        """
+        if self.config.decode_mode == 'beam':
+            return self.beam_search_batch(trees, queries, query_raws)
+        return self.sample_batch(trees, queries, query_raws, greedy=self.config.decode_mode == 'greedy')
+
+    def prepare_decoding(self, trees, queries, query_raws):
+        """
+        encoding of the examples and the tensors which stay fixed during the decoding
+        :return: h, c, ctx, ctx_mask, the context projections, the example beams, the copy targets,
+                 the (node_num, rule_num) mask of the rules which can not expand the node types
+                 and the (rule_num + target_vocab_size, rule_embed_dim) embeddings of the actions
+        """
+        # (batch_size, decoder_hidden_dim), (batch_size, decoder_hidden_dim)
+        # (batch_size, query_length, encoder_hidden_dim), (batch_size, query_length) or None
+        # context projections are computed once and gathered for the hypotheses of every step
+        # (batch_size, query_length, attention_hidden_dim), (batch_size, query_length, ptrnet_hidden_dim)
+        h, c, ctx, ctx_mask, ctx_att_trans, ctx_ptr_trans = self.encode_for_decoding(trees, queries)
+        batch_size = len(trees)
+        cuda = h.is_cuda
+        h = h if self.thought else init_var(batch_size, self.config.decoder_hidden_dim,
+                                            cuda=cuda, scale=0.1, training=self.training)
+        c = c if self.thought else init_var(batch_size, self.config.decoder_hidden_dim,
+                                            cuda=cuda, scale=0.1, training=self.training)
+
+        beams = [ExampleBeam(example_id, Hyp(self.grammar), query_raw, self.terminal_vocab)
+                 for example_id, query_raw in enumerate(query_raws)]
+        # (batch_size, query_length)
+        copy_targets = self.copy_targets(beams, ctx.size()[1], cuda)
+
+        # rules which can not expand the node types
+        # (node_num, rule_num)
+        rule_invalid = torch.from_numpy(self.grammar.rule_mask.astype(np.uint8)) == 0
+        if cuda:
+            rule_invalid = rule_invalid.cuda()
+        # embeddings of the candidate actions, rule applications followed by word generations
+        # (rule_num + target_vocab_size, rule_embed_dim)
+        action_embedding = torch.cat([self.rule_gen_softmax.weight, self.vocab_gen_softmax.weight])
+
+        return h, c, ctx, ctx_mask, ctx_att_trans, ctx_ptr_trans, \
+               beams, copy_targets, rule_invalid, action_embedding
+
+    def beam_search_batch(self, trees, queries, query_raws):
+        """
+        beam search over a batch of examples, hypotheses of all the examples are
+        carried in one flat batch through every decoding step. The beam state stays on the device
+        and is reindexed by the surviving hypotheses, only the selected candidates are moved to python
+        :return: list of completed hypotheses sorted by score, one list for every example
+        """
+        h, c, ctx, ctx_mask, ctx_att_trans, ctx_ptr_trans, \
+        beams, (copy_ids, copy_weights, unk_mask), rule_invalid, action_embedding = \
+            self.prepare_decoding(trees, queries, query_raws)
+        batch_size = len(trees)
+        cuda = h.is_cuda
+
+        # hidden states of all hypotheses at every time step, hypotheses keep their rows
+        history = HistoryBuffer(self.config.decode_max_time_step, batch_size * self.config.beam_size,
+                                self.config.decoder_hidden_dim, cuda=cuda)
+
+        # beam state of the live hypotheses, rows follow the hypotheses of the live beams
+        # (hyp_num, rule_embed_dim)
+        prev_action_embed = zeros_var(batch_size, self.config.rule_embed_dim, cuda=cuda)
+        # (hyp_num)
+        hyp_scores = torch.zeros(batch_size).double()
+        hyp_scores = hyp_scores.cuda() if cuda else hyp_scores
+        node_ids = [int(self.grammar.tables.root)] * batch_size
+        parent_rule_ids = [-1] * batch_size
+        start_time = time.perf_counter()
 
-        root_hyp = Hyp(self.grammar)
-        root_hyp.state = h
-        root_hyp.cell = c
-        root_hyp.action_embed = Var(zeros(self.config.rule_embed_dim, cuda=h.is_cuda), requires_grad=False)
-        root_hyp.node_id = self.grammar.get_node_type_id(root_hyp.tree.type)
-        root_hyp.parent_rule_id = -1
+        for t in range(self.config.decode_max_time_step):
+            live_beams = [beam for beam in beams if beam.hyp_samples]
+            if not live_beams:
+                break
+            hyp_samples = [hyp for beam in live_beams for hyp in beam.hyp_samples]
+            self.decode_counters['steps'] += len(live_beams)
 
-        hyp_samples = [root_hyp]
+            # (hyp_num)
+            example_ids = from_long_list([beam.example_id for beam in live_beams for _ in beam.hyp_samples], cuda)
+            example_ids = Var(example_ids, requires_grad=False)
+            node_id = from_long_list(node_ids, cuda)
+            parent_rule_id = from_long_list(parent_rule_ids, cuda)
 
-        # source word id in the terminal vocab
-        src_token_id = self.terminal_vocab.convertToIdx(query_raw, Constants.UNK_WORD)
-        unk_pos_list = [x for x, t in enumerate(src_token_id) if t == Constants.UNK]
+            h, c, \
+            rule_prob, gen_action_prob, vocab_prob, copy_prob = \
+                self.forward_hyps(t, hyp_samples, example_ids, history,
+                                  h, c, prev_action_embed, node_id, parent_rule_id,
+                                  ctx, ctx_att_trans, ctx_ptr_trans, ctx_mask)
 
-        # sometimes a word may appear multi-times in the source, in this case,
-        # we just copy its first appearing position. Therefore we mask the words
-        # appearing second and onwards to -1
-        token_set = set()
-        for i, tid in enumerate(src_token_id):
-            if tid in token_set:
-                src_token_id[i] = -1
+            # (hyp_num)
+            is_value = torch.from_numpy(self.grammar.tables.value_mask[node_ids].astype(np.uint8)) == 1
+            is_value = is_value.cuda() if cuda else is_value
+            # (hyp_num, rule_num + target_vocab_size), (hyp_num)
+            cand_scores, unk_pos = self.score_candidates(hyp_scores, node_id, is_value, rule_invalid,
+                                                         copy_ids.index_select(0, example_ids.data),
+                                                         copy_weights.index_select(0, example_ids.data),
+                                                         unk_mask.index_select(0, example_ids.data),
+                                                         rule_prob.data, gen_action_prob.data,
+                                                         vocab_prob.data, copy_prob.data)
+
+            # slots of the hypotheses when the live beams are padded to beam_size rows
+            # (hyp_num)
+            slots = from_long_list([i * self.config.beam_size + k for i, beam in enumerate(live_beams)
+                                    for k in range(len(beam.hyp_samples))], cuda)
+            # (live_beam_num, beam_size)
+            top_scores, top_rows, top_actions = self.top_candidates(cand_scores, slots, len(live_beams))
+
+            # only the selected candidates cross to python for the tree bookkeeping
+            top_scores = top_scores.cpu().numpy()
+            top_rows = top_rows.cpu().numpy()
+            top_actions = top_actions.cpu().numpy()
+            unk_pos = unk_pos.cpu().numpy()
+
+            src_rows, action_ids, node_ids, parent_rule_ids, scores = [], [], [], [], []
+            for i, beam in enumerate(live_beams):
+                live = self.expand_beam(t, beam, hyp_samples, history, unk_pos,
+                                        top_scores[i], top_rows[i], top_actions[i])
+                if live and self.stop_beam(t, beam, start_time):
+                    beam.hyp_samples = []
+                    continue
+                for row, action_id, new_hyp in live:
+                    src_rows.append(row)
+                    action_ids.append(action_id)
+                    node_ids.append(new_hyp.frontier_nt().type_id)
+                    parent_rule_ids.append(new_hyp.frontier_parent().rule_id)
+                    scores.append(new_hyp.score)
+
+            if not src_rows:
+                break
+            # the continuations take the states of their hypotheses with a single index_select
+            src_rows = Var(from_long_list(src_rows, cuda), requires_grad=False)
+            h = h.index_select(0, src_rows)
+            c = c.index_select(0, src_rows)
+            prev_action_embed = action_embedding.index_select(0, Var(from_long_list(action_ids, cuda),
+                                                                     requires_grad=False))
+            hyp_scores = torch.DoubleTensor(scores)
+            hyp_scores = hyp_scores.cuda() if cuda else hyp_scores
+
+        return [sorted(beam.completed_hyps, key=lambda x: x.score, reverse=True) for beam in beams]
+
+    def stop_beam(self, t, beam, start_time):
+        """
+        whether the search of an example ends before its live hypotheses are completed.
+        The scores only decrease, up to MAX_STEP_SCORE per step from the 1.e-7 added to the probabilities,
+        which bounds the scores the live hypotheses can reach: beam_stop 'top1' stops when no live hypothesis can become the best
+        completed one, 'all' when none can get ahead of any completed one, so the completed ones keep
+        their ranking. decode_time_budget stops the examples decoded for longer than the budget.
+        :param t: time step of the expanded hypotheses
+        :param start_time: start of the decoding of the example
+        """
+        if self.config.beam_stop != 'none' and beam.completed_hyps:
+            remaining_steps = self.config.decode_max_time_step - t - 1
+            bound = max(hyp.score for hyp in beam.hyp_samples) + remaining_steps * MAX_STEP_SCORE
+            completed_scores = [hyp.score for hyp in beam.completed_hyps]
+            if self.config.beam_stop == 'top1':
+                threshold = max(completed_scores)
             else:
-                token_set.add(tid)
+                threshold = min(completed_scores)
+            if bound <= threshold:
+                self.decode_counters['early_stops'] += 1
+                return True
+
+        if 0 < self.config.decode_time_budget < time.perf_counter() - start_time:
+            self.decode_counters['budget_stops'] += 1
+            return True
+
+        return False
+
+    def sample_batch(self, trees, queries, query_raws, greedy=True):
+        """
+        greedy or sampling decoding of a batch of examples, a single hypothesis of every example takes
+        the most probable or a sampled action of its frontier node in every step, without the beam
+        bookkeeping. Sampling is restricted by sample_top_k and sample_top_p of the config.
+        :return: list with the completed hypothesis of every example, empty when the decoding
+                 runs out of time steps
+        """
+        h, c, ctx, ctx_mask, ctx_att_trans, ctx_ptr_trans, \
+        beams, (copy_ids, copy_weights, unk_mask), rule_invalid, action_embedding = \
+            self.prepare_decoding(trees, queries, query_raws)
+        batch_size = len(trees)
+        cuda = h.is_cuda
+        rule_num = self.config.rule_num
+
+        history = HistoryBuffer(self.config.decode_max_time_step, batch_size,
+                                self.config.decoder_hidden_dim, cuda=cuda)
+
+        # one hypothesis for every live example, rows follow live_beams
+        live_beams = beams
+        # (hyp_num, rule_embed_dim)
+        prev_action_embed = zeros_var(batch_size, self.config.rule_embed_dim, cuda=cuda)
+        node_ids = [int(self.grammar.tables.root)] * batch_size
+        parent_rule_ids = [-1] * batch_size
 
         for t in range(self.config.decode_max_time_step):
-            hyp_num = len(hyp_samples)
-            # (hyp_num, decoder_hidden_dim)
-            h = torch.stack([hyp.state for hyp in hyp_samples])
-            c = torch.stack([hyp.cell for hyp in hyp_samples])
-
-            # (hyp_num, max_time_step, decoder_hidden_dim)
-            hist_h = Var(zeros(hyp_num, self.config.decode_max_time_step, self.config.decoder_hidden_dim, cuda=h.is_cuda), requires_grad=False)
+            hyp_samples = [beam.hyp_samples[0] for beam in live_beams]
+            self.decode_counters['steps'] += len(live_beams)
 
-            if t > 0:
-                for i, hyp in enumerate(hyp_samples):
-                    hist_h[i, :len(hyp.hist_h), :] = torch.stack(hyp.hist_h)
-                    # for j, h in enumerate(hyp.hist_h):
-                    #    hist_h[i, j] = h
-
-            # (hyp_num, decoder_hidden_dim)
-            prev_action_embed = torch.stack([hyp.action_embed for hyp in hyp_samples])
             # (hyp_num)
-            node_id = from_long_list([hyp.node_id for hyp in hyp_samples], h.is_cuda)
-            parent_rule_id = from_long_list([hyp.parent_rule_id for hyp in hyp_samples], h.is_cuda)
-            parent_t = from_long_list([hyp.get_action_parent_t() for hyp in hyp_samples], h.is_cuda)
-
-            # (hyp_num, 1, decoder_hidden_dim)
-            index = Var(parent_t.unsqueeze(1).unsqueeze(2).expand(-1, -1, self.config.decoder_hidden_dim), requires_grad=False)
-            # (hyp_num, decoder_hidden_dim)
-            parent_h = torch.gather(hist_h, 1, index).squeeze(1)
-            # (live_hyp_num, query_length, decoder_hidden_dim)
-            ctx_tiled = ctx.repeat(live_hyp_num, 1, 1)
+            example_ids = Var(from_long_list([beam.example_id for beam in live_beams], cuda), requires_grad=False)
+            node_id = from_long_list(node_ids, cuda)
 
             h, c, \
             rule_prob, gen_action_prob, vocab_prob, copy_prob = \
-                self.forward_decoder_step(t,
-                                          h, c, hist_h,
-                                          prev_action_embed,
-                                          node_id, parent_rule_id,
-                                          parent_h,
-                                          ctx_tiled)
-
-            new_hyp_samples = []
-
-            # move probabilities to cpu and numpy
-            if self.config.cuda:
-                rule_prob = rule_prob.cpu()
-                gen_action_prob = gen_action_prob.cpu()
-                vocab_prob = vocab_prob.cpu()
-                copy_prob = copy_prob.cpu()
-
-            rule_prob = rule_prob.data.numpy()
-            gen_action_prob = gen_action_prob.data.numpy()
-            vocab_prob = vocab_prob.data.numpy()
-            copy_prob = copy_prob.data.numpy()
-
-            # iterating over items in the beam
-            word_prob = gen_action_prob[:, 0:1] * vocab_prob
-            word_prob[:, Constants.UNK] = 0
-
-            hyp_scores = np.array([hyp.score for hyp in hyp_samples])
-
-            # word_prob[:, src_token_id] += gen_action_prob[:, 1:2] * copy_prob[:, :len(src_token_id)]
-            # word_prob[:, unk] = 0
-
-            rule_apply_cand_hyp_ids = []
-            rule_apply_cand_scores = []
-            rule_apply_cand_rules = []
-            rule_apply_cand_rule_ids = []
-
-            hyp_frontier_nts = []
-            word_gen_hyp_ids = []
-            cand_copy_probs = []
-            unk_words = []
-
-            for k in range(live_hyp_num):
-                hyp = hyp_samples[k]
-
-                # if k == 0:
-                #     print 'Top Hyp: %s' % hyp.tree.__repr__()
-
-                frontier_nt = hyp.frontier_nt()
-                hyp_frontier_nts.append(frontier_nt)
-
-                assert hyp, 'none hyp!'
-
-                # if it's not a leaf
-                if not self.grammar.is_value_node(frontier_nt):
-                    # iterate over all the possible rules
-                    rules = self.grammar[frontier_nt.as_type_node] if self.config.head_nt_constraint else self.grammar
-                    assert len(rules) > 0, 'fail to expand nt node %s' % frontier_nt
-                    for rule in rules:
-                        rule_id = self.grammar.rule_to_id[rule]
-
-                        cur_rule_score = np.log(rule_prob[k, rule_id] + 1.e-7)
-                        new_hyp_score = hyp.score + cur_rule_score
-
-                        rule_apply_cand_hyp_ids.append(k)
-                        rule_apply_cand_scores.append(new_hyp_score)
-                        rule_apply_cand_rules.append(rule)
-                        rule_apply_cand_rule_ids.append(rule_id)
-
-                else:  # it's a leaf that holds values
-                    cand_copy_prob = 0.0
-                    for i, tid in enumerate(src_token_id):
-                        if tid != -1:
-                            word_prob[k, tid] += gen_action_prob[k, 1] * copy_prob[k, i]
-                            cand_copy_prob = gen_action_prob[k, 1]
-
-                    # and unk copy probability
-                    if len(unk_pos_list) > 0:
-                        unk_pos = copy_prob[k, unk_pos_list].argmax()
-                        unk_pos = unk_pos_list[unk_pos]
-
-                        unk_copy_score = gen_action_prob[k, 1] * copy_prob[k, unk_pos]
-                        word_prob[k, Constants.UNK] = unk_copy_score
-
-                        unk_word = query_raw[unk_pos]
-                        unk_words.append(unk_word)
-
-                        cand_copy_prob = gen_action_prob[k, 1]
-
-                    word_gen_hyp_ids.append(k)
-                    cand_copy_probs.append(cand_copy_prob)
-
-            # prune the hyp space
-            if completed_hyp_num >= self.config.beam_size:
-                break
-
-            word_prob = np.log(word_prob + 1.e-7)
-
-            word_gen_hyp_num = len(word_gen_hyp_ids)
-            rule_apply_cand_num = len(rule_apply_cand_scores)
-
-            if word_gen_hyp_num > 0:
-                word_gen_cand_scores = hyp_scores[word_gen_hyp_ids, None] + word_prob[word_gen_hyp_ids, :]
-                word_gen_cand_scores_flat = word_gen_cand_scores.flatten()
-
-                cand_scores = np.concatenate([rule_apply_cand_scores, word_gen_cand_scores_flat])
-            else:
-                cand_scores = np.array(rule_apply_cand_scores)
-
-            top_cand_ids = (-cand_scores).argsort()[:self.config.beam_size - completed_hyp_num]
-
-            # expand_cand_num = 0
-            for cand_id in top_cand_ids:
-                # cand is rule application
-                new_hyp = None
-                if cand_id < rule_apply_cand_num:
-                    hyp_id = rule_apply_cand_hyp_ids[cand_id]
-                    hyp = hyp_samples[hyp_id]
-                    rule_id = rule_apply_cand_rule_ids[cand_id]
-                    rule = rule_apply_cand_rules[cand_id]
-                    new_hyp_score = rule_apply_cand_scores[cand_id]
-
-                    new_hyp = Hyp(hyp)
-                    new_hyp.apply_rule(rule)
-
-                    new_hyp.score = new_hyp_score
-                    new_hyp.state = h[hyp_id].clone()
-                    new_hyp.hist_h.append(new_hyp.state.clone())
-                    new_hyp.cell = c[hyp_id].clone()
-                    new_hyp.action_embed = rule_embedding[rule_id]
+                self.forward_hyps(t, hyp_samples, example_ids, history,
+                                  h, c, prev_action_embed, node_id, from_long_list(parent_rule_ids, cuda),
+                                  ctx, ctx_att_trans, ctx_ptr_trans, ctx_mask)
+
+            # hypotheses on a nonterminal apply a rule, the ones on a value node generate a word
+            is_value = self.grammar.tables.value_mask[node_ids]
+            rule_rows = np.nonzero(~is_value)[0].tolist()
+            word_rows = np.nonzero(is_value)[0].tolist()
+            # (hyp_num), action ids as in the beam search: rule applications followed by word generations
+            action_ids = node_id.new(len(hyp_samples)).zero_()
+            action_prob = rule_prob.data.new(len(hyp_samples)).zero_()
+            unk_pos = node_id.new(len(hyp_samples)).zero_()
+
+            if rule_rows:
+                rows = from_long_list(rule_rows, cuda)
+                # (rule_hyp_num, rule_num)
+                prob = rule_prob.data.index_select(0, rows)
+                if self.config.head_nt_constraint:
+                    prob = prob.masked_fill(rule_invalid.index_select(0, node_id.index_select(0, rows)), 0.)
+                ids = self.choose_ids(prob, greedy)
+                action_ids.index_copy_(0, rows, ids)
+                action_prob.index_copy_(0, rows, prob.gather(1, ids.unsqueeze(1)).squeeze(1))
+
+            if word_rows:
+                rows = from_long_list(word_rows, cuda)
+                word_example_ids = example_ids.data.index_select(0, rows)
+                # (word_hyp_num, target_vocab_size), (word_hyp_num)
+                prob, word_unk_pos = self.word_prob(copy_ids.index_select(0, word_example_ids),
+                                                    copy_weights.index_select(0, word_example_ids),
+                                                    unk_mask.index_select(0, word_example_ids),
+                                                    gen_action_prob.data.index_select(0, rows),
+                                                    vocab_prob.data.index_select(0, rows),
+                                                    copy_prob.data.index_select(0, rows))
+                ids = self.choose_ids(prob, greedy)
+                action_ids.index_copy_(0, rows, ids + rule_num)
+                action_prob.index_copy_(0, rows, prob.gather(1, ids.unsqueeze(1)).squeeze(1))
+                unk_pos.index_copy_(0, rows, word_unk_pos)
+
+            action_scores = torch.log(action_prob + 1.e-7).cpu().numpy()
+            unk_pos = unk_pos.cpu().numpy()
+
+            src_rows, live_action_ids, next_beams, node_ids, parent_rule_ids = [], [], [], [], []
+            for row, (beam, hyp, action_id) in enumerate(zip(live_beams, hyp_samples, action_ids.cpu().numpy())):
+                action_id = int(action_id)
+                # the hypothesis is not shared with other hypotheses, it is continued in place
+                hyp.score += float(action_scores[row])
+                if action_id < rule_num:
+                    hyp.apply_rule(action_id, history.row(t, row))
                 else:
-                    tid = (cand_id - rule_apply_cand_num) % word_prob.shape[1]
-                    word_gen_hyp_id = int((cand_id - rule_apply_cand_num) / word_prob.shape[1])
-                    hyp_id = word_gen_hyp_ids[word_gen_hyp_id]
-
+                    tid = action_id - rule_num
                     if tid == Constants.UNK:
-                        token = unk_words[word_gen_hyp_id]
+                        token = beam.query_raw[unk_pos[row]]
                     else:
                         token = self.terminal_vocab.getLabel(tid)
+                    hyp.append_token(token, history.row(t, row))
 
-                    frontier_nt = hyp_frontier_nts[hyp_id]
-                    # if frontier_nt.type == int and (not (is_numeric(token) or token == '<eos>')):
-                    #     continue
-
-                    hyp = hyp_samples[hyp_id]
-                    new_hyp_score = word_gen_cand_scores[word_gen_hyp_id, tid]
-
-                    new_hyp = Hyp(hyp)
-                    new_hyp.append_token(token)
-
-                    # if log:
-                    #     cand_copy_prob = cand_copy_probs[word_gen_hyp_id]
-                    #     if cand_copy_prob > 0.5:
-                    #         new_hyp.log += ' || ' + str(new_hyp.frontier_nt()) + '{copy[%s][p=%f]}' % (
-                    #             token, cand_copy_prob)
-
-                    new_hyp.score = new_hyp_score
-                    new_hyp.state = h[hyp_id].clone()
-                    new_hyp.hist_h.append(new_hyp.state.clone())
-                    new_hyp.cell = c[hyp_id].clone()
-                    new_hyp.action_embed = vocab_embedding[int(tid)].clone()
-                    new_hyp.node_id = self.grammar.get_node_type_id(frontier_nt)
-
-                # get the new frontier nt after rule application
-                new_frontier_nt = new_hyp.frontier_nt()
-
-                # if new_frontier_nt is None, then we have a new completed hyp!
-                if new_frontier_nt is None:
-                    # if t <= 1:
-                    #     continue
-                    new_hyp.n_timestep = t + 1
-                    completed_hyps.append(new_hyp)
-                    completed_hyp_num += 1
+                if hyp.frontier_nt() is None:
+                    hyp.n_timestep = t + 1
+                    beam.completed_hyps.append(hyp)
+                    beam.completed_hyp_num += 1
                 else:
-                    new_hyp.node_id = self.grammar.get_node_type_id(new_frontier_nt.type)
-                    # new_hyp.parent_rule_id = grammar.rule_to_id[
-                    #     new_frontier_nt.parent.to_rule(include_value=False)]
-                    new_hyp.parent_rule_id = self.grammar.rule_to_id[new_frontier_nt.parent.applied_rule]
+                    src_rows.append(row)
+                    live_action_ids.append(action_id)
+                    next_beams.append(beam)
+                    node_ids.append(hyp.frontier_nt().type_id)
+                    parent_rule_ids.append(hyp.frontier_parent().rule_id)
 
-                    new_hyp_samples.append(new_hyp)
+            if not src_rows:
+                break
+            live_beams = next_beams
+            src_rows = Var(from_long_list(src_rows, cuda), requires_grad=False)
+            h = h.index_select(0, src_rows)
+            c = c.index_select(0, src_rows)
+            prev_action_embed = action_embedding.index_select(0, Var(from_long_list(live_action_ids, cuda),
+                                                                     requires_grad=False))
+
+        return [beam.completed_hyps for beam in beams]
+
+    def choose_ids(self, prob, greedy):
+        """
+        :param prob: (batch_size, n) probabilities
+        :return: (batch_size) the most probable ids or the sampled ones
+        """
+        if greedy:
+            return prob.max(dim=1)[1]
+        return sample_ids(prob, self.config.sample_top_k, self.config.sample_top_p)
+
+    def forward_hyps(self, t, hyp_samples, example_ids, history,
+                     h, c, prev_action_embed, node_id, parent_rule_id,
+                     ctx, ctx_att_trans, ctx_ptr_trans, ctx_mask):
+        """
+        decoder step of the hypotheses of the decoded batch, the hidden states are written to the history
+        :param example_ids: (hyp_num), example of every hypothesis
+        :param ctx, ctx_att_trans, ctx_ptr_trans, ctx_mask: context of the examples, gathered for the hypotheses
+        :return: outputs of forward_decoder_step
+        """
+        cuda = h.is_cuda
+        if t > 0:
+            # (hyp_num)
+            parent_rows = from_long_list([hyp.get_action_parent_row() for hyp in hyp_samples], cuda)
+            # (hyp_num, decoder_hidden_dim)
+            parent_h = history.gather(Var(parent_rows, requires_grad=False))
+        else:
+            parent_h = zeros_var(len(hyp_samples), self.config.decoder_hidden_dim, cuda=cuda)
 
-                    # expand_cand_num += 1
-                    # if expand_cand_num >= beam_size - completed_hyp_num:
-                    #     break
+        if t > 0 and self.config.tree_attention:
+            # (hyp_num, t)
+            hist_rows = from_long_list([hyp.get_hist_rows() for hyp in hyp_samples], cuda)
+            # (hyp_num, t, decoder_hidden_dim)
+            hist_h = history.gather(Var(hist_rows, requires_grad=False))
+        else:
+            hist_h = None
+
+        h, c, \
+        rule_prob, gen_action_prob, vocab_prob, copy_prob = \
+            self.forward_decoder_step(t,
+                                      h, c, hist_h,
+                                      prev_action_embed,
+                                      node_id, parent_rule_id,
+                                      parent_h,
+                                      ctx.index_select(0, example_ids),
+                                      ctx_att_trans.index_select(0, example_ids),
+                                      ctx_ptr_trans.index_select(0, example_ids),
+                                      None if ctx_mask is None else ctx_mask.index_select(0, example_ids))
+        history.write(t, h)
 
-                    # cand is word generation
+        return h, c, \
+               rule_prob, gen_action_prob, vocab_prob, copy_prob
 
-            live_hyp_num = min(len(new_hyp_samples), self.config.beam_size - completed_hyp_num)
-            if live_hyp_num < 1:
+    def copy_targets(self, beams, query_length, cuda):
+        """
+        scatter index of the copy probabilities of the decoded batch
+        :return: (batch_size, query_length) terminal ids of the source positions, weights of the positions
+                 which are copied (first appearances of the tokens) and mask of the unk positions
+        """
+        copy_ids = np.zeros((len(beams), query_length), dtype=np.int64)
+        copy_weights = np.zeros((len(beams), query_length), dtype=np.float32)
+        unk_mask = np.zeros((len(beams), query_length), dtype=np.uint8)
+        for i, beam in enumerate(beams):
+            copied = beam.copy_positions < query_length
+            copy_ids[i, beam.copy_positions[copied]] = beam.copy_token_ids[copied]
+            copy_weights[i, beam.copy_positions[copied]] = 1.
+            unk_mask[i, [pos for pos in beam.unk_pos_list if pos < query_length]] = 1
+
+        copy_ids, copy_weights, unk_mask = \
+            torch.from_numpy(copy_ids), torch.from_numpy(copy_weights), torch.from_numpy(unk_mask) == 1
+        if cuda:
+            copy_ids, copy_weights, unk_mask = copy_ids.cuda(), copy_weights.cuda(), unk_mask.cuda()
+        return copy_ids, copy_weights, unk_mask
+
+    def score_candidates(self, hyp_scores, node_id, is_value, rule_invalid,
+                         copy_ids, copy_weights, unk_mask,
+                         rule_prob, gen_action_prob, vocab_prob, copy_prob):
+        """
+        scores of all the continuations of the hypotheses, computed on the device
+        :param hyp_scores: (hyp_num), double scores of the hypotheses
+        :param node_id: (hyp_num), frontier node type ids
+        :param is_value: (hyp_num), hypotheses with a value node on the frontier, which generate words
+        :param rule_invalid: (node_num, rule_num)
+        :param copy_ids, copy_weights, unk_mask: (hyp_num, query_length), copy targets of the hypotheses
+        :param rule_prob, gen_action_prob, vocab_prob, copy_prob: probability tensors of the decoder step
+        :return: (hyp_num, rule_num + target_vocab_size) candidate scores, rule applications followed
+                 by word generations, -inf for the entries which are not candidates,
+                 and (hyp_num) source positions of the copied unk words
+        """
+        # (hyp_num, 1)
+        hyp_scores = hyp_scores.unsqueeze(1)
+
+        # (hyp_num, rule_num)
+        rule_scores = torch.log(rule_prob + 1.e-7).double() + hyp_scores
+        if self.config.head_nt_constraint:
+            rule_scores = rule_scores.masked_fill(rule_invalid.index_select(0, node_id), -np.inf)
+        rule_scores = rule_scores.masked_fill(is_value.unsqueeze(1), -np.inf)
+
+        # (hyp_num, target_vocab_size), (hyp_num)
+        word_prob, unk_pos = self.word_prob(copy_ids, copy_weights, unk_mask, gen_action_prob, vocab_prob, copy_prob)
+
+        word_scores = torch.log(word_prob + 1.e-7).double() + hyp_scores
+        word_scores = word_scores.masked_fill(is_value.unsqueeze(1) == 0, -np.inf)
+
+        return torch.cat([rule_scores, word_scores], dim=1), unk_pos
+
+    def word_prob(self, copy_ids, copy_weights, unk_mask, gen_action_prob, vocab_prob, copy_prob):
+        """
+        probabilities of the generated and copied words
+        :param copy_ids, copy_weights, unk_mask: (hyp_num, query_length), copy targets of the hypotheses
+        :return: (hyp_num, target_vocab_size) word probabilities, the unk probability is the one
+                 of the most probable unk source position, and (hyp_num) these positions
+        """
+        # (hyp_num, target_vocab_size)
+        word_prob = gen_action_prob[:, 0:1] * vocab_prob
+        word_prob[:, Constants.UNK] = 0
+        # (hyp_num, 1)
+        copy_gate = gen_action_prob[:, 1:2]
+
+        # copy probabilities of the source tokens are added to their terminal ids,
+        # positions which are not copied add zeros
+        word_prob.scatter_add_(1, copy_ids, copy_gate * copy_prob * copy_weights)
+
+        # and unk copy probability
+        # (hyp_num)
+        unk_copy_prob, unk_pos = copy_prob.masked_fill(unk_mask == 0, -1.).max(dim=1)
+        has_unk = unk_mask.sum(dim=1) > 0
+        word_prob[:, Constants.UNK] = torch.where(has_unk, copy_gate[:, 0] * unk_copy_prob,
+                                                  word_prob[:, Constants.UNK])
+
+        return word_prob, unk_pos
+
+    def top_candidates(self, cand_scores, slots, live_beam_num):
+        """
+        the beam_size best candidates of every example, the candidates of every hypothesis are
+        selected first, then the best of them for every example
+        :param cand_scores: (hyp_num, action_num)
+        :param slots: (hyp_num), row of every hypothesis when the beams are padded to beam_size rows
+        :return: (live_beam_num, beam_size) scores in descending order, hypothesis rows and action ids,
+                 -inf scores of the beams with less candidates
+        """
+        beam_size = self.config.beam_size
+        # (hyp_num, beam_size)
+        row_scores, row_actions = cand_scores.topk(beam_size, dim=1)
+
+        # (live_beam_num * beam_size, beam_size)
+        padded_scores = cand_scores.new(live_beam_num * beam_size, beam_size).fill_(-np.inf)
+        padded_scores.index_copy_(0, slots, row_scores)
+        rows = torch.arange(0, slots.size()[0]).long()
+        beam_offsets = torch.arange(0, live_beam_num).long() * beam_size
+        if slots.is_cuda:
+            rows, beam_offsets = rows.cuda(), beam_offsets.cuda()
+        slot_rows = slots.new(live_beam_num * beam_size).zero_()
+        slot_rows.index_copy_(0, slots, rows)
+
+        # (live_beam_num, beam_size)
+        top_scores, top_ids = padded_scores.view(live_beam_num, -1).topk(beam_size, dim=1)
+        # (live_beam_num * beam_size)
+        top_slots = (top_ids // beam_size + beam_offsets.unsqueeze(1)).view(-1)
+        top_rows = slot_rows.index_select(0, top_slots)
+        top_actions = row_actions[top_rows, top_ids.view(-1) % beam_size]
+
+        return top_scores, top_rows.view(live_beam_num, beam_size), top_actions.view(live_beam_num, beam_size)
+
+    def expand_beam(self, t, beam, hyp_samples, history, unk_pos, top_scores, top_rows, top_actions):
+        """
+        continues the hypotheses of one example with its selected candidates
+        :param hyp_samples: hypotheses of the decoded batch
+        :param unk_pos: (hyp_num), source positions of the copied unk words
+        :param top_scores, top_rows, top_actions: (beam_size), candidates of the example in descending order
+        :return: list of (row, action id, hypothesis) of the live continuations
+        """
+        rule_num = self.config.rule_num
+        cand_num = self.config.beam_size - beam.completed_hyp_num
+
+        new_hyp_samples = []
+        live = []
+        for new_hyp_score, row, action_id in zip(top_scores[:cand_num], top_rows[:cand_num], top_actions[:cand_num]):
+            if not np.isfinite(new_hyp_score):
                 break
+            row, action_id = int(row), int(action_id)
+            hyp = hyp_samples[row]
+
+            new_hyp = Hyp(hyp)
+            new_hyp.score = float(new_hyp_score)
+            # cand is rule application
+            if action_id < rule_num:
+                new_hyp.apply_rule(action_id, history.row(t, row))
+            # cand is word generation
+            else:
+                tid = action_id - rule_num
+                if tid == Constants.UNK:
+                    token = beam.query_raw[unk_pos[row]]
+                else:
+                    token = self.terminal_vocab.getLabel(tid)
+                new_hyp.append_token(token, history.row(t, row))
+
+            # if new_frontier_nt is None, then we have a new completed hyp!
+            if new_hyp.frontier_nt() is None:
+                new_hyp.n_timestep = t + 1
+                beam.completed_hyps.append(new_hyp)
+                beam.completed_hyp_num += 1
+            else:
+                new_hyp_samples.append(new_hyp)
+                live.append((row, action_id, new_hyp))
+
+        beam.hyp_samples = new_hyp_samples
+        return live
+
+    def encode_for_decoding(self, trees, queries):
+        """
+        encoding and context projections of the examples of a decoded batch. In evaluation mode with
+        encoder_cache_mb, the outputs of the examples are cached by the parameter versions, the query
+        token ids and the tree structure, only the examples which are not cached are encoded.
+        :return: h, c, ctx, ctx_mask, ctx_att_trans, ctx_ptr_trans
+        """
+        if self.training or self.config.encoder_cache_mb <= 0:
+            h, c, ctx, ctx_mask = self.encode_examples(trees, queries)
+            return h, c, ctx, ctx_mask, self.decoder.project_context(ctx), self.src_ptr_net.project_context(ctx)
+
+        cache = self.encoder_cache
+        cache.max_bytes = int(self.config.encoder_cache_mb * 2 ** 20)
+        # in-place updates of the parameters, e.g. by load_state_dict, change their versions
+        version = tuple([p._version for p in self.parameters()])
+        lengths = [tree.size() for tree in trees]
+        keys = [(version, tuple(query[:length].tolist()), tree_key(tree))
+                for tree, query, length in zip(trees, queries, lengths)]
+        # (h, c, ctx, ctx_att_trans, ctx_ptr_trans) of every example without padding
+        outputs = [cache.get(key) for key in keys]
+
+        missing = [i for i, output in enumerate(outputs) if output is None]
+        if missing:
+            h, c, ctx, _ = self.encode_examples([trees[i] for i in missing],
+                                                queries.index_select(0, from_long_list(missing, queries.is_cuda)))
+            ctx_att_trans = self.decoder.project_context(ctx)
+            ctx_ptr_trans = self.src_ptr_net.project_context(ctx)
+            for k, i in enumerate(missing):
+                # copies, slices would keep the outputs of the whole batch alive in the cache
+                outputs[i] = tuple([x.detach().clone() for x in (h[k], c[k], ctx[k, :lengths[i]],
+                                                                 ctx_att_trans[k, :lengths[i]],
+                                                                 ctx_ptr_trans[k, :lengths[i]])])
+                cache.put(keys[i], outputs[i])
+
+        query_length = max(lengths)
+        h = torch.stack([output[0] for output in outputs])
+        c = torch.stack([output[1] for output in outputs])
+        ctx, ctx_att_trans, ctx_ptr_trans = [add_padding_and_stack([output[j] for output in outputs], queries.is_cuda,
+                                                                   max_length=query_length) for j in (2, 3, 4)]
+        return h, c, ctx, context_mask(lengths, query_length, queries.is_cuda), ctx_att_trans, ctx_ptr_trans
+
+    def encode_examples(self, trees, queries):
+        """
+        encoding of the examples of a decoded batch
+        :return: h, c, ctx and (batch_size, query_length) mask of the padded context positions,
+                 None when no example is padded
+        """
+        lengths = [tree.size() for tree in trees]
+        if self.config.encoder == 'recursive-lstm':
+            h, c, ctx = self.forward_encode(trees, queries)
+        else:
+            # sequence encoders would read the padding of the shorter queries, examples are encoded one by one
+            encoded = [self.forward_encode([tree], query[None, :length])
+                       for tree, query, length in zip(trees, queries, lengths)]
+            h = torch.cat([h for h, _, _ in encoded], dim=0)
+            c = torch.cat([c for _, c, _ in encoded], dim=0)
+            ctx = add_padding_and_cat([ctx for _, _, ctx in encoded], queries.is_cuda)
 
-            hyp_samples = new_hyp_samples[:live_hyp_num]
-            # hyp_samples = sorted(new_hyp_samples, key=lambda x: x.score, reverse=True)[:live_hyp_num]
-
-        completed_hyps = sorted(completed_hyps, key=lambda x: x.score, reverse=True)
-
-        return completed_hyps
+        return h, c, ctx, context_mask(lengths, ctx.shape[1], queries.is_cuda)
 
     def forward_encode(self, trees, queries):
         queries = Var(queries, requires_grad=False)
@@ -347,7 +663,7 @@ class Tree2TreeModel(nn.Module):
                              prev_action_embed,
                              node_id, par_rule_id,
                              parent_h,
-                             ctx):
+                             ctx, ctx_att_trans, ctx_ptr_trans, ctx_mask=None):
         # (batch_size, node_embed_dim)
         node_embed = self.node_embedding[node_id]
 
@@ -366,8 +682,8 @@ class Tree2TreeModel(nn.Module):
 
         h, c, ctx_vec = self.decoder(t,
                                      decoder_input,
-                                     ctx, hist_h,
-                                     h, c, parent_h)
+                                     ctx, ctx_att_trans, hist_h,
+                                     h, c, parent_h, ctx_mask)
 
         # (batch_size, decoder_hidden_state + encoder_hidden_dim)
         decoder_concat = torch.cat([h, ctx_vec], dim=-1)
@@ -379,7 +695,10 @@ class Tree2TreeModel(nn.Module):
         decoder_hidden_state_trans_token = F.tanh(decoder_hidden_state_trans_token)
 
         # (batch_size, rule_num)
-        rule_prob = self.rule_gen_softmax(decoder_hidden_state_trans_rule)
+        if self.config.head_nt_constraint and self.config.constrained_rule_softmax:
+            rule_prob = self.constrained_rule_prob(decoder_hidden_state_trans_rule, node_id)
+        else:
+            rule_prob = self.rule_gen_softmax(decoder_hidden_state_trans_rule)
 
         # (batch_size, 2)
         gen_action_prob = self.terminal_gen_softmax(h)
@@ -388,11 +707,44 @@ class Tree2TreeModel(nn.Module):
         vocab_prob = self.vocab_gen_softmax(decoder_hidden_state_trans_token)
 
         # (batch_size, query_length)
-        copy_prob = self.src_ptr_net(ctx, decoder_concat.unsqueeze(1)).squeeze(1)
+        copy_prob = self.src_ptr_net(ctx, decoder_concat.unsqueeze(1), ctx_ptr_trans, ctx_mask).squeeze(1)
 
         return h, c, \
                rule_prob, gen_action_prob, vocab_prob, copy_prob
 
+    def constrained_rule_prob(self, decoder_hidden_state_trans_rule, node_id):
+        """
+        rule probabilities normalized over the rules of the frontier node type only,
+        the rule layer is computed just for these rules
+        :param decoder_hidden_state_trans_rule: (batch_size, rule_embed_dim)
+        :param node_id: (batch_size), frontier node type ids
+        :return: (batch_size, rule_num), zeros for the rules of other node types
+        """
+        node_ids = node_id.cpu().numpy()
+        rule_counts = self.grammar.rule_counts[node_ids]
+        subset_size = max(1, rule_counts.max())
+        cuda = decoder_hidden_state_trans_rule.is_cuda
+
+        # (batch_size, subset_size)
+        rule_ids = torch.from_numpy(self.grammar.rule_id_matrix[node_ids, :subset_size])
+        rule_counts = torch.from_numpy(rule_counts).long()
+        padding = torch.arange(0, subset_size).long()[None] >= rule_counts[:, None]
+        # value nodes have no rules, a padding position keeps the softmax of their rows defined
+        softmax_padding = padding.clone()
+        softmax_padding[:, 0] = 0
+        if cuda:
+            rule_ids, padding, softmax_padding = rule_ids.cuda(), padding.cuda(), softmax_padding.cuda()
+        rule_ids = Var(rule_ids, requires_grad=False)
+
+        # (batch_size, subset_size)
+        subset_prob = self.rule_gen_softmax.forward_subset(decoder_hidden_state_trans_rule, rule_ids,
+                                                           Var(softmax_padding, requires_grad=False))
+        subset_prob = subset_prob.masked_fill(Var(padding, requires_grad=False), 0.)
+
+        # (batch_size, rule_num), padding positions add zeros to rule 0
+        rule_prob = zeros_var(subset_prob.size()[0], self.config.rule_num, cuda=cuda)
+        return rule_prob.scatter_add(1, rule_ids, subset_prob)
+
     def forward_train(self, trees, queries,
                       tgt_node_seq, tgt_action_seq, tgt_par_rule_seq, tgt_par_t_seq, tgt_action_seq_type):
 
@@ -476,3 +828,48 @@ class Tree2TreeModel(nn.Module):
         # nll loss
         loss = torch.neg(torch.sum(tgt_prob))
         return loss
+
+
+def context_mask(lengths, query_length, cuda):
+    """
+    :return: (batch_size, query_length) mask of the padded context positions, None when nothing is padded
+    """
+    if min(lengths) == query_length:
+        return None
+    # (batch_size, query_length)
+    ctx_mask = torch.arange(0, query_length).long()[None] >= torch.LongTensor(lengths)[:, None]
+    if cuda:
+        ctx_mask = ctx_mask.cuda()
+    return Var(ctx_mask, requires_grad=False)
+
+
+class ExampleBeam(object):
+    """
+    beam search bookkeeping of one example of the decoded batch
+    """
+    def __init__(self, example_id, root_hyp, query_raw, terminal_vocab):
+        self.example_id = example_id
+        self.query_raw = query_raw
+
+        # live hypotheses, the example is finished when there are none left
+        self.hyp_samples = [root_hyp]
+        self.completed_hyps = []
+        self.completed_hyp_num = 0
+
+        # source word id in the terminal vocab
+        self.src_token_id = terminal_vocab.convertToIdx(query_raw, Constants.UNK_WORD)
+        self.unk_pos_list = [x for x, t in enumerate(self.src_token_id) if t == Constants.UNK]
+
+        # sometimes a word may appear multi-times in the source, in this case,
+        # we just copy its first appearing position. Therefore we mask the words
+        # appearing second and onwards to -1
+        token_set = set()
+        for i, tid in enumerate(self.src_token_id):
+            if tid in token_set:
+                self.src_token_id[i] = -1
+            else:
+                token_set.add(tid)
+
+        # scatter index of the copy probabilities: source positions and the terminal ids of their tokens
+        self.copy_positions = np.array([i for i, tid in enumerate(self.src_token_id) if tid != -1], dtype=np.int64)
+        self.copy_token_ids = np.array([tid for tid in self.src_token_id if tid != -1], dtype=np.int64)
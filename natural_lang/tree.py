@@ -1,17 +1,19 @@
 import networkx as nx
-
-
-def _structural_similarity(tree1, tree2):
-    sim = 1
-    length = min(len(tree1.children), len(tree2.children))
-    for i in range(length):
-        sim += _structural_similarity(tree1.children[i], tree2.children[i])
-    return sim
+import numpy as np
 
 
 def structural_similarity(tree1, tree2):
-    sim = _structural_similarity(tree1, tree2)
-    max_size = max(tree1.size(), tree2.size())
+    arrays1, arrays2 = tree1.arrays(), tree2.arrays()
+    sim = 0
+    # pairs of nodes at the same position in both trees
+    stack = [(arrays1.root, arrays2.root)]
+    while stack:
+        node1, node2 = stack.pop()
+        sim += 1
+        children1 = arrays1.get_children(node1)
+        children2 = arrays2.get_children(node2)
+        stack.extend(zip(children1, children2))
+    max_size = max(arrays1.size, arrays2.size)
     return sim/max_size
 
 
@@ -49,9 +51,45 @@ def read_tree(line, labels=None):
                     idx = parent
     if root is not None:
         root._data = d
+        root._arrays = TreeArrays(root)
     return root
 
 
+class TreeArrays(object):
+    """
+    flat array form of a parsed tree, nodes are numbered in the order of tree.data()
+    """
+    def __init__(self, root):
+        nodes = root.data()
+        position = {node.idx: pos for pos, node in enumerate(nodes)}
+
+        self.size = len(nodes)
+        self.root = position[root.idx]
+        # token index of every node
+        self.idx = np.array([node.idx for node in nodes], dtype=np.int64)
+        # parent position, -1 for the root
+        self.parents = np.array([position[node.parent.idx] if node.parent is not None else -1
+                                 for node in nodes], dtype=np.int64)
+
+        # children in CSR form: children of node i are children[child_offsets[i]:child_offsets[i+1]]
+        self.child_offsets = np.zeros(self.size + 1, dtype=np.int64)
+        self.child_offsets[1:] = np.cumsum([node.num_children for node in nodes])
+        self.children = np.array([position[ch.idx] for node in nodes for ch in node.children], dtype=np.int64)
+
+        # height of every node, leaves have height 0
+        self.heights = np.zeros(self.size, dtype=np.int64)
+        bfs = [self.root]
+        for node in bfs:
+            bfs.extend(self.get_children(node))
+        for node in reversed(bfs):
+            children = self.get_children(node)
+            if len(children) > 0:
+                self.heights[node] = self.heights[children].max() + 1
+
+    def get_children(self, node):
+        return self.children[self.child_offsets[node]:self.child_offsets[node + 1]]
+
+
 # tree object from stanfordnlp/treelstm
 class Tree(object):
     def __init__(self):
@@ -67,10 +105,17 @@ class Tree(object):
     def size(self):
         if hasattr(self, '_size'):
             return self._size
-        count = 1
-        for i in range(self.num_children):
-            count += self.children[i].size()
-        self._size = count
+        # subtrees without a size yet, their sizes are counted from the leaves up
+        subtrees = [self]
+        for node in subtrees:
+            for ch in node.children:
+                if not hasattr(ch, '_size'):
+                    subtrees.append(ch)
+        for node in reversed(subtrees):
+            count = 1
+            for ch in node.children:
+                count += ch._size
+            node._size = count
         return self._size
 
     def data(self):
@@ -80,6 +125,15 @@ class Tree(object):
         assert self._data is not None, "Only root node contains the tree list!"
         return self._data
 
+    def arrays(self):
+        """
+        :return: flat array form of the tree
+        """
+        if not hasattr(self, '_arrays'):
+            # trees cached before the array form was introduced
+            self._arrays = TreeArrays(self)
+        return self._arrays
+
     def depth(self):
         if getattr(self, '_depth'):
             return self._depth
@@ -5,11 +5,14 @@ import astor
 import os
 import numpy as np
 import math
+import multiprocessing
 import shutil
+import tempfile
 import pandas as pd
 
 from lang.parse import decode_tree_to_python_ast
 from utils.general import get_batches
+from datasets.sampler import BucketBatchSampler
 from utils.eval import evaluate_decode_result
 from utils.io import send_telegram
 
@@ -19,6 +22,8 @@ class Trainer(object):
         self.config = config
         self.model = model
         self.optimizer = optimizer
+        # (dataset, sampler) of the last trained dataset, the sampler keeps the sizes of its examples
+        self.sampler = None
 
     def train_all(self, train_data, dev_data, test_data, results_dir):
         max_epoch = self.config.max_epoch
@@ -109,11 +114,15 @@ class Trainer(object):
         self.optimizer.zero_grad()
         total_loss = 0.0
         batch_size = self.config.batch_size
-        indices = torch.randperm(len(dataset))
+        sampler = self.get_sampler(dataset)
+        if self.config.bucket_batching:
+            batches = [torch.from_numpy(batch) for batch in sampler.batches()]
+        else:
+            batches = list(get_batches(torch.randperm(len(dataset)), batch_size))
+        logging.info('Epoch {} padding waste: {:.3f}.'.format(epoch+1, sampler.padding_waste(batches)))
         if self.config.cuda:
-            indices = indices.cuda()
-        total_batches = math.floor(len(indices)/batch_size)+1
-        batches = list(get_batches(indices, batch_size))
+            batches = [batch.cuda() for batch in batches]
+        total_batches = len(batches)
 
         if st_batch:
             batches = batches[st_batch:]
@@ -133,35 +142,130 @@ class Trainer(object):
 
         return total_loss/len(dataset)
 
+    def get_sampler(self, dataset):
+        """
+        bucket sampler of the dataset, built once for all the epochs. Its example sizes also give
+        the padding waste of the batches when bucket_batching is off
+        """
+        if self.sampler is None or self.sampler[0] is not dataset:
+            self.sampler = (dataset, BucketBatchSampler(dataset, self.config.batch_size,
+                                                        self.config.bucket_tree_width,
+                                                        self.config.bucket_action_width))
+        return self.sampler[1]
+
     def validate(self, dataset, epoch, out_dir):
         self.model.eval()
-        cum_bleu, cum_acc = 0.0, 0.0
-        errors = 0
+        indices = list(range(len(dataset)))
+        desc = 'Testing epoch '+str(epoch+1)+''
+
+        workers = self.config.valid_workers
+        if workers > 1 and self.config.cuda:
+            logging.info('Parallel validation is not supported with cuda, validating in one process.')
+            workers = 1
 
-        for idx in tqdm(range(len(dataset)), desc='Testing epoch '+str(epoch+1)+''):
-            data_entry = dataset[idx]
-
-            cand_list = self.model(data_entry['query_tree'], data_entry['query'], data_entry['query_tokens'])
-            candidats = []
-            for cid, cand in enumerate(cand_list[:self.config.beam_size]):
-                try:
-                    ast_tree = decode_tree_to_python_ast(cand.tree)
-                    code = astor.to_source(ast_tree)
-                    candidats.append((cid, cand, ast_tree, code))
-                except:
-                    logging.debug("Exception in converting tree to code:"
-                                  "id: {}, beam pos: {}".format(idx, cid))
-                    errors += 1
-            if len(candidats) > 0:
-                bleu, acc, error = evaluate_decode_result(data_entry, idx, candidats[0], out_dir)
-
-                cum_bleu += bleu
-                cum_acc += acc
-                # errors += 1
+        if workers > 1:
+            cum_bleu, cum_acc, errors = self.validate_parallel(dataset, indices, out_dir, workers, desc)
+        else:
+            with tqdm(total=len(dataset), desc=desc) as progress:
+                cum_bleu, cum_acc, errors = self.validate_shard(dataset, indices, out_dir, progress)
+            if self.config.encoder_cache_mb > 0:
+                cache = self.model.encoder_cache
+                logging.info('Encoder cache: {} hits, {} misses, {} entries.'.format(cache.hits, cache.misses,
+                                                                                    len(cache)))
 
         cum_bleu /= len(dataset)
         cum_acc /= len(dataset)
-        errors /= (len(dataset) * self.config.beam_size)
+        # greedy and sampling decoding give one candidate per example
+        cand_num = self.config.beam_size if self.config.decode_mode == 'beam' else 1
+        errors /= (len(dataset) * cand_num)
+
+        return cum_bleu, cum_acc, errors
+
+    def validate_shard(self, dataset, indices, out_dir, progress=None):
+        """
+        decodes and evaluates the examples, outputs are appended to the files in out_dir in the order of indices
+        :return: sums of bleu, accuracy and errors over the examples
+        """
+        cum_bleu, cum_acc = 0.0, 0.0
+        errors = 0
+
+        for batch in get_batches(indices, self.config.decode_batch_size):
+            data_entries, trees, queries = dataset.get_decode_batch(batch)
+            cand_lists = self.model.decode_batch(trees, queries,
+                                                 [data_entry['query_tokens'] for data_entry in data_entries])
+
+            for idx, data_entry, cand_list in zip(batch, data_entries, cand_lists):
+                candidats = []
+                for cid, cand in enumerate(cand_list[:self.config.beam_size]):
+                    try:
+                        ast_tree = decode_tree_to_python_ast(cand.tree)
+                        code = astor.to_source(ast_tree)
+                        candidats.append((cid, cand, ast_tree, code))
+                    except:
+                        logging.debug("Exception in converting tree to code:"
+                                      "id: {}, beam pos: {}".format(idx, cid))
+                        errors += 1
+                if len(candidats) > 0:
+                    bleu, acc, error = evaluate_decode_result(data_entry, idx, candidats[0], out_dir)
+
+                    cum_bleu += bleu
+                    cum_acc += acc
+                    # errors += 1
+            if progress is not None:
+                progress.update(len(batch))
+
+        return cum_bleu, cum_acc, errors
+
+    def validate_parallel(self, dataset, indices, out_dir, workers, desc):
+        """
+        validation in forked worker processes, which share the model and the dataset read-only.
+        Every shard writes its outputs into its own directory, the shards are merged into out_dir
+        in the order of the examples.
+        :return: sums of bleu, accuracy and errors over the examples
+        """
+        global _validation
+        # a few shards per worker keep the workers busy when some shards decode slower
+        shard_size = int(math.ceil(len(indices) / (workers * 4)))
+        shards = list(get_batches(indices, shard_size))
+        shard_dirs = []
+
+        # workers see it through fork, nothing is pickled
+        _validation = (self, dataset)
+        threads = max(1, multiprocessing.cpu_count() // workers)
+        cum_bleu, cum_acc, errors = 0.0, 0.0, 0
+        cache_hits, cache_misses = 0, 0
+        try:
+            # fresh directories, so directories left by an interrupted validation do not clash
+            for k in range(len(shards)):
+                shard_dirs.append(tempfile.mkdtemp(prefix='shard_{}_'.format(k), dir=out_dir))
+
+            with multiprocessing.get_context('fork').Pool(workers, initializer=torch.set_num_threads,
+                                                          initargs=(threads,)) as pool:
+                with tqdm(total=len(indices), desc=desc) as progress:
+                    for shard, (bleu, acc, error, hits, misses) in zip(shards, pool.imap(_validate_shard,
+                                                                                        zip(shards, shard_dirs))):
+                        cum_bleu += bleu
+                        cum_acc += acc
+                        errors += error
+                        cache_hits += hits
+                        cache_misses += misses
+                        progress.update(len(shard))
+
+            # outputs of the shards replace the outputs in out_dir
+            merged = set()
+            for shard_dir in shard_dirs:
+                for file_name in sorted(os.listdir(shard_dir)):
+                    with open(os.path.join(shard_dir, file_name)) as f_shard, \
+                            open(os.path.join(out_dir, file_name), 'a' if file_name in merged else 'w') as f:
+                        shutil.copyfileobj(f_shard, f)
+                    merged.add(file_name)
+        finally:
+            _validation = None
+            for shard_dir in shard_dirs:
+                shutil.rmtree(shard_dir, ignore_errors=True)
+
+        if self.config.encoder_cache_mb > 0:
+            logging.info('Encoder cache: {} hits, {} misses in {} workers.'.format(cache_hits, cache_misses, workers))
 
         return cum_bleu, cum_acc, errors
 
@@ -185,3 +289,20 @@ class Trainer(object):
         msg = "Finished experiment with config {}.\n\n".format(self.config)
         msg += "\n".join(["{}: {}.".format(k, v) for k, v in report_dict.items()])
         send_telegram(msg)
+
+
+# trainer and dataset of the running parallel validation, inherited by the forked workers
+_validation = None
+
+
+def _validate_shard(shard):
+    """
+    :return: sums of bleu, accuracy and errors over the examples of the shard,
+             and the encoder cache hits and misses of the worker while decoding them
+    """
+    indices, out_dir = shard
+    trainer, dataset = _validation
+    cache = trainer.model.encoder_cache
+    hits, misses = cache.hits, cache.misses
+    cum_bleu, cum_acc, errors = trainer.validate_shard(dataset, indices, out_dir)
+    return cum_bleu, cum_acc, errors, cache.hits - hits, cache.misses - misses